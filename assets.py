@@ -1,15 +1,24 @@
+from concurrent.futures import ProcessPoolExecutor
 import os
-import random
-from typing import Dict, List, Union
+from typing import Dict, Iterator, List, Optional, Set, Tuple, Union
 import warnings
 
 import numpy as np
 from progressbar import ProgressBar
 
-from config import ASSETS_PATH
-from utils import (choose_version, CONFIG_DICT, create_csv, create_dir,
-                   create_assets_json, erase_edition, extract_rarity_from_csv,
-                   generate_paths, permission, PNG)
+from config import (ASSETS_PATH, EDITION_EXPORTS, EDITION_SEED,
+                    GENERATION_WORKERS, RANKED_SAMPLING_LIMIT,
+                    RANKED_SAMPLING_THRESHOLD, SAMPLING_BATCH_SIZE)
+from catalog import preflight_assets, update_catalog
+from constraints import (apply_constraints, compile_constraints,
+                         count_valid_combinations,
+                         enumerate_valid_combinations)
+from edition import (CANDIDATE_STREAM, EditionSeed, get_generator,
+                     load_edition_state, RANKED_STREAM, save_edition_state,
+                     update_exports)
+import instrument
+from utils import (choose_version, CONFIG_DICT, create_dir, erase_edition,
+                   extract_rarity_from_csv, generate_paths, permission, PNG)
 
 
 warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -24,6 +33,10 @@ def get_weighted_rarities(arr):
 def parse_config(
     version_path: str) -> List[Dict[str, Union[int, str, List[int]]]]:
     edition_config = extract_rarity_from_csv(version_path)
+    # Trait images are listed and inspected through the catalog,
+    # which only reads what changed since the last run
+    catalog = update_catalog(version_path,
+                             [layer['name'] for layer in edition_config])
     # Loop through all layers defined in CONFIG
     for layer in edition_config:
 
@@ -39,20 +52,34 @@ def parse_config(
 
         # Re-assign final values to main CONFIG
         # Get trait array in sorted order
-        layer['traits'] = sorted([trait[:PNG] for trait
-                                  in os.listdir(layer_path)
-                                  if trait[0] != '.'])
+        files = sorted(catalog[layer['name']])
+        layer['traits'] = [trait[:PNG] for trait in files]
+        # Trait info from the catalog, for the preflight checks
+        layer['assets'] = [catalog[layer['name']][trait] for trait in files]
 
         if len(layer['traits']) == len(layer['rarity_weights']) - 1:
             # msg = 'Rarity weights are invalid.'
             # msg += ' Make sure you have the correct number of rarity weights'
             # raise ValueError(msg)
             layer['traits'].insert(0, None)
+            layer['assets'].insert(0, None)
 
         layer['rarity_weights'] = get_weighted_rarities(
             layer['rarity_weights'])
         layer['cum_rarity_weights'] = np.cumsum(layer['rarity_weights'])
 
+        # Build trait paths once instead of once per generated avatar
+        layer['paths'] = [
+            os.path.join(layer_path, f'{trait}.png')
+            if trait is not None else None for trait in layer['traits']]
+
+        # Map trait names (as written to the csv) back to their indices
+        layer['trait_index'] = {
+            trait if trait is not None else 'none': i
+            for i, trait in enumerate(layer['traits'])}
+
+    preflight_assets(edition_config)
+    compile_constraints(version_path, edition_config)
     return edition_config
 
 
@@ -64,89 +91,323 @@ def get_total_combinations(edition_config: CONFIG_DICT) -> int:
     return total
 
 
-# Select an index based on rarity weights
-def select_index(cum_rarities, rand):
-    cum_rarities = [0] + list(cum_rarities)
-    for i in range(len(cum_rarities) - 1):
-        if rand >= cum_rarities[i] and rand <= cum_rarities[i+1]:
-            return i
-
-    # Should not reach here if everything works okay
-    return None
-
-
-# Generate a set of traits given rarities
-def generate_trait_set_from_config(edition_config: CONFIG_DICT,
-                                   version_path: str) -> List[List[str]]:
+# Draw a batch of candidates based on rarity weights.
+# Each row holds one trait index per layer
+def sample_trait_indices(edition_config: CONFIG_DICT, size: int,
+                         rng: np.random.Generator) -> np.ndarray:
+    rand = rng.random((size, len(edition_config)))
+    indices = np.empty(rand.shape, dtype=np.intp)
+    for j, layer in enumerate(edition_config):
+        cum_rarities = layer['cum_rarity_weights']
+        # Zero-weight traits share their cumulative value with the previous
+        # trait, so searching from the right never selects them
+        indices[:, j] = np.minimum(
+            np.searchsorted(cum_rarities, rand[:, j], side='right'),
+            len(cum_rarities) - 1)
+    return indices
+
+
+# Turn a row of trait indices into trait names and trait paths
+def get_trait_data(edition_config: CONFIG_DICT,
+                   row: List[int]) -> List[List[str]]:
     trait_set = []
     trait_paths = []
-
-    for layer in edition_config:
-        # Extract list of traits and cumulative rarity weights
-        traits, cum_rarities = layer['traits'], layer['cum_rarity_weights']
-
-        # Generate a random number
-        rand_num = random.random()
-
-        # Select an element index
-        # based on random number and cumulative rarity weights
-        idx = select_index(cum_rarities, rand_num)
-
-        # Add selected trait to trait set
-        trait_set.append(traits[idx])
-        for i, trait in enumerate(trait_set):
-            if trait is None:
-                trait_set[i] = 'none'
-
-        # Add trait path to trait paths if the trait has been selected
-        if traits[idx] is not None:
-            trait_path = os.path.join(version_path, ASSETS_PATH,
-                                      layer['name'], f'{traits[idx]}.png')
-            trait_paths.append(trait_path)
-
+    for layer, idx in zip(edition_config, row):
+        trait = layer['traits'][idx]
+        if trait is None:
+            trait_set.append('none')
+        else:
+            trait_set.append(trait)
+            trait_paths.append(layer['paths'][idx])
     return [trait_set, trait_paths]
 
 
-def validate_traits(trait_set: List[str]) -> bool:
-    if trait_set[5] == 'Yellow' and trait_set[4] == 'Yellow':
-        return False
-    if (trait_set[1] in ('Black', 'Red')
-        and trait_set[3] not in ('Black', 'Face', 'Sad')):
-        return False
-    return True
+# Get the mixed-radix place value of every layer.
+# Each combination of traits is a number whose digits are trait indices
+def get_radix_strides(edition_config: CONFIG_DICT) -> np.ndarray:
+    sizes = [len(layer['traits']) for layer in edition_config]
+    strides = np.ones(len(sizes), dtype=np.int64)
+    for j in range(len(sizes) - 2, -1, -1):
+        strides[j] = strides[j + 1] * sizes[j + 1]
+    return strides
+
+
+# Map rows of trait indices to their combination ranks
+def rank_trait_indices(edition_config: CONFIG_DICT,
+                       indices: np.ndarray) -> np.ndarray:
+    return indices.astype(np.int64) @ get_radix_strides(edition_config)
+
+
+# Map combination ranks back to rows of trait indices
+def unrank_trait_indices(edition_config: CONFIG_DICT,
+                         ranks: np.ndarray) -> np.ndarray:
+    strides = get_radix_strides(edition_config)
+    indices = np.empty((len(ranks), len(edition_config)), dtype=np.intp)
+    for j, layer in enumerate(edition_config):
+        indices[:, j] = ranks // strides[j] % len(layer['traits'])
+    return indices
+
+
+# Get the rarity weight of every row of trait indices
+def get_combination_weights(edition_config: CONFIG_DICT,
+                            indices: np.ndarray) -> np.ndarray:
+    weights = np.ones(len(indices))
+    for j, layer in enumerate(edition_config):
+        weights *= layer['rarity_weights'][indices[:, j]]
+    return weights
+
+
+# Get the tuple of trait indices identifying a trait set
+def get_trait_key(edition_config: CONFIG_DICT,
+                  trait_set: List[str]) -> Tuple[int, ...]:
+    return tuple(layer['trait_index'][trait]
+                 for layer, trait in zip(edition_config, trait_set))
+
+
+# Uniqueness index of the trait sets an edition already has.
+# Trait sets of a saved edition are kept as the sorted array of their
+# combination ranks, so it is loaded as is instead of being hashed again.
+# Trait sets added afterwards go into a hashed set of trait index tuples
+class UniqueIndex:
+    def __init__(self, edition_config: CONFIG_DICT,
+                 ranks: Optional[np.ndarray] = None) -> None:
+        self.edition_config = edition_config
+        self.strides = get_radix_strides(edition_config).tolist()
+        self.base = np.empty(0, dtype=np.int64) if ranks is None else ranks
+        self.added: Set[Tuple[int, ...]] = set()
+
+    def __len__(self) -> int:
+        return len(self.base) + len(self.added)
+
+    def __contains__(self, key: Tuple[int, ...]) -> bool:
+        if key in self.added:
+            return True
+        if not len(self.base):
+            return False
+        rank = sum(i * stride for i, stride in zip(key, self.strides))
+        pos = np.searchsorted(self.base, rank)
+        return pos < len(self.base) and self.base[pos] == rank
+
+    def add(self, key: Tuple[int, ...]) -> None:
+        self.added.add(key)
+
+    # Tell which rows of trait indices are not in the saved trait sets
+    def not_in_base(self, indices: np.ndarray) -> np.ndarray:
+        if not len(self.base):
+            return np.ones(len(indices), dtype=bool)
+        ranks = rank_trait_indices(self.edition_config, indices)
+        pos = np.minimum(np.searchsorted(self.base, ranks),
+                         len(self.base) - 1)
+        return self.base[pos] != ranks
+
+    # Get the sorted ranks of every trait set in the index
+    def ranks(self) -> np.ndarray:
+        if not self.added:
+            return self.base
+        added = rank_trait_indices(self.edition_config,
+                                   np.array(list(self.added)))
+        return np.sort(np.concatenate([self.base, added]))
+
+
+# Create a hashed uniqueness index of all existing trait sets
+def create_unique_index(edition_config: CONFIG_DICT,
+                        all_data: List[List[List[str]]]) -> UniqueIndex:
+    unique_index = UniqueIndex(edition_config)
+    for data in all_data:
+        unique_index.add(get_trait_key(edition_config, data[0]))
+    return unique_index
+
+
+# Select distinct trait sets by sampling combination ranks directly.
+# Every remaining valid combination is enumerated, so this never rejects
+# a candidate and fails right away if not enough combinations are left.
+# Returns None if there are too many combinations to enumerate
+def sample_ranked_indices(edition_config: CONFIG_DICT, count: int,
+                          unique_index: UniqueIndex,
+                          rng: np.random.Generator) -> Optional[np.ndarray]:
+    indices = enumerate_valid_combinations(edition_config,
+                                           RANKED_SAMPLING_LIMIT)
+    if indices is None:
+        return None
+    # Ranked order, so a seed selects the same trait sets however the
+    # combinations were enumerated
+    ranks = rank_trait_indices(edition_config, indices)
+    order = np.argsort(ranks)
+    indices = indices[order[~np.isin(ranks[order], unique_index.ranks())]]
+    weights = get_combination_weights(edition_config, indices)
+
+    if len(indices) < count:
+        raise ValueError(f'Only {len(indices)} more distinct avatars'
+                         ' can be created')
+
+    # Weighted sampling without replacement (Efraimidis-Spirakis).
+    # Ordering by key matches drawing by weight and rejecting duplicates
+    keys = np.log(rng.random(len(indices))) / weights
+    selected = np.argpartition(-keys, count - 1)[:count]
+    return indices[selected[np.argsort(-keys[selected])]]
+
+
+# Draw the block-th block of candidates of an edition's candidate stream and
+# keep those allowed by the constraints, along with their positions in the
+# block. Blocks only depend on the seed, so any process can draw any of them
+def sample_block(edition_config: CONFIG_DICT, seed: int,
+                 block: int) -> Tuple[np.ndarray, np.ndarray]:
+    rng = get_generator(seed, CANDIDATE_STREAM, block)
+    rows = sample_trait_indices(edition_config, SAMPLING_BATCH_SIZE, rng)
+    allowed = apply_constraints(edition_config, rows)
+    return np.flatnonzero(allowed), rows[allowed]
+
+
+# Get blocks of candidates in order, starting from the given block.
+# Blocks after the first are drawn ahead by a pool of processes,
+# which changes how fast they come but never what they hold
+def iter_candidate_blocks(edition_config: CONFIG_DICT, seed: int, block: int,
+                          workers: Optional[int] = GENERATION_WORKERS
+                          ) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+    yield (block, *sample_block(edition_config, seed, block))
+    block += 1
+    if workers == 1:
+        while True:
+            yield (block, *sample_block(edition_config, seed, block))
+            block += 1
+
+    pool = ProcessPoolExecutor(max_workers=workers)
+    ahead = 2 * (workers or os.cpu_count() or 1)
+    try:
+        while True:
+            futures = [pool.submit(sample_block, edition_config, seed, b)
+                       for b in range(block, block + ahead)]
+            for future in futures:
+                yield (block, *future.result())
+                block += 1
+    finally:
+        pool.shutdown(cancel_futures=True)
 
 
 # Generate the image set.
-def generate_asset_data(
-    version_path:str, edition_config: CONFIG_DICT, count: int,
-    all_data: List[List[List[str]]] = []) -> List[List[List[str]]]:
-
+# Generate new trait sets, yielding batches of trait indices as they are
+# accepted.
+# Candidates are taken in stream order, so a seed always gives the same
+# trait sets whatever the number of workers, and extending an edition
+# carries on from the first candidate it did not consider
+def iter_asset_data(edition_config: CONFIG_DICT, count: int,
+                    unique_index: UniqueIndex, seed: EditionSeed,
+                    workers: Optional[int] = GENERATION_WORKERS
+                    ) -> Iterator[List[List[int]]]:
+    if count <= 0:
+        return
+    block, skip = divmod(seed.position, SAMPLING_BATCH_SIZE)
+
+    # Rejection sampling stalls when most combinations are taken,
+    # so switch to sampling the remaining combinations directly
+    total = count_valid_combinations(edition_config)
+    rows = None
+    if (len(unique_index) + count > total * RANKED_SAMPLING_THRESHOLD
+        and get_total_combinations(edition_config) < 2 ** 63):
+        rows = sample_ranked_indices(edition_config, count, unique_index,
+                                     seed.generator(RANKED_STREAM, block))
+    if rows is not None:
+        # Later candidates come from streams this draw did not touch
+        seed.position = (block + 1) * SAMPLING_BATCH_SIZE
+        instrument.count('generate.candidates', len(rows))
+        instrument.count('generate.accepted', len(rows))
+        for start in range(0, len(rows), SAMPLING_BATCH_SIZE):
+            batch = rows[start:start + SAMPLING_BATCH_SIZE].tolist()
+            unique_index.added.update(map(tuple, batch))
+            yield batch
+        return
+
+    done = 0
+    blocks = iter_candidate_blocks(edition_config, seed.seed, block, workers)
+    try:
+        for block, positions, candidates in blocks:
+            # Candidates drawn by a previous run were already considered
+            drawn = positions >= skip
+            first, skip = skip, 0
+            positions, candidates = positions[drawn], candidates[drawn]
+            fresh = unique_index.not_in_base(candidates)
+            batch = []
+            end = SAMPLING_BATCH_SIZE
+            for position, row in zip(positions[fresh].tolist(),
+                                     candidates[fresh].tolist()):
+                key = tuple(row)
+                if key in unique_index.added:
+                    continue
+                unique_index.add(key)
+                batch.append(row)
+                if len(batch) == count - done:
+                    end = position + 1
+                    break
+            done += len(batch)
+            seed.position = block * SAMPLING_BATCH_SIZE + end
+            if instrument.enabled:
+                # Candidates left out by constraints or already taken
+                allowed = int(np.count_nonzero(positions < end))
+                instrument.count('generate.candidates', end - first)
+                instrument.count('generate.constrained',
+                                 end - first - allowed)
+                instrument.count('generate.duplicates', allowed - len(batch))
+                instrument.count('generate.accepted', len(batch))
+            if batch:
+                yield batch
+            if done == count:
+                return
+    finally:
+        blocks.close()
+
+
+# Generate the trait indices of new trait sets, one row per trait set
+def generate_trait_indices(edition_config: CONFIG_DICT, count: int,
+                           unique_index: UniqueIndex,
+                           seed: EditionSeed) -> np.ndarray:
+    rows = []
     bar = ProgressBar(max_value=count).start()
-    i = 0
-
-    # Create the images data
-    while len(all_data) < count:
-        # Get a random set of valid traits based on rarity weights
-        traits = generate_trait_set_from_config(edition_config, version_path)
-        if traits not in all_data and validate_traits(traits[0]):
-            all_data.append(traits)
-            i += 1
-            bar.update(i)
-
+    for batch in iter_asset_data(edition_config, count, unique_index, seed):
+        rows.extend(batch)
+        bar.update(len(rows))
     bar.update(count)
     print()
-    return all_data
+    return np.array(rows, dtype=np.intp).reshape(-1, len(edition_config))
 
 
-def create_csv_data(edition_config: CONFIG_DICT,
-                    csv_data: List[List[str]]) -> List[str]:
-    header = ['']
-    for layer in edition_config:
-        header.append(layer['name'].title())
+def generate_asset_data(
+    edition_config: CONFIG_DICT, count: int,
+    all_data: List[List[List[str]]] = [],
+    unique_index: Optional[UniqueIndex] = None,
+    seed: Optional[EditionSeed] = None) -> List[List[List[str]]]:
+    all_data = list(all_data)
+    if unique_index is None:
+        unique_index = create_unique_index(edition_config, all_data)
+    if seed is None:
+        seed = EditionSeed(EDITION_SEED)
 
-    metadata = [[i + 1] + t for i, t in enumerate(csv_data)]
-    metadata.insert(0, header)
-    return metadata
+    # Create the images data
+    rows = generate_trait_indices(edition_config, count - len(all_data),
+                                  unique_index, seed)
+    return all_data + [get_trait_data(edition_config, row)
+                       for row in rows.tolist()]
+
+
+# Load what extending an edition needs: its trait matrix, uniqueness index
+# and seed
+def load_edition(paths: Dict[str, str], edition_config: CONFIG_DICT
+                 ) -> Tuple[np.ndarray, UniqueIndex, EditionSeed]:
+    state = load_edition_state(paths, edition_config)
+    if state is None:
+        traits = np.empty((0, len(edition_config)), dtype=np.intp)
+        ranks, seed = None, EditionSeed()
+    else:
+        traits, ranks, seed = state
+
+    if get_total_combinations(edition_config) >= 2 ** 63:
+        # Ranks do not fit in 64 bits, hash every trait set instead
+        unique_index = UniqueIndex(edition_config)
+        unique_index.added.update(map(tuple, traits.tolist()))
+        return traits, unique_index, seed
+
+    if ranks is None:
+        ranks = np.sort(rank_trait_indices(edition_config, traits))
+    return traits, UniqueIndex(edition_config, ranks), seed
 
 
 def choose_edition_name(version_path: str) -> str:
@@ -168,7 +429,8 @@ def choose_edition_name(version_path: str) -> str:
 
 # Main function. Point of entry
 def create_edition_data(version_path: str, edition_name: str = '',
-                        prev_data: List[List[List[str]]] = []) -> str:
+                        extend: bool = False,
+                        seed: Optional[int] = EDITION_SEED) -> str:
     if not edition_name:
         edition_name = choose_edition_name(version_path)
 
@@ -176,45 +438,58 @@ def create_edition_data(version_path: str, edition_name: str = '',
     edition_config = parse_config(version_path)
     print('Assets look great! We are good to go!\n')
 
-    total_combos = get_total_combinations(edition_config)
+    paths = generate_paths(version_path, edition_name)
+    if extend:
+        traits, unique_index, edition_seed = load_edition(paths,
+                                                          edition_config)
+    else:
+        traits = np.empty((0, len(edition_config)), dtype=np.intp)
+        unique_index = UniqueIndex(edition_config)
+        edition_seed = EditionSeed(seed)
+
+    total_combos = count_valid_combinations(edition_config)
     print(f'You can create a total of {total_combos} distinct avatars')
 
     msg1 = msg2 = ''
-    if prev_data:
-        existing_amount = len(prev_data)
+    existing_amount = len(traits)
+    if extend:
         msg1 = f'{existing_amount} avatars already exist\n'
         msg2 = 'additional '
-        total_combos -= existing_amount
+        total_combos = max(total_combos - existing_amount, 0)
+    if not total_combos:
+        print(f'{msg1}No {msg2}distinct avatars can be created.\n')
+        return edition_name if extend else ''
     msg = f'{msg1}How many {msg2}avatars would you like to create?'
-    msg += f' Enter a number greater than 0 and smaller than {total_combos}:'
+    msg += f' Enter a number between 1 and {total_combos}:'
     print(msg)
     num_avatars = -1
-    while num_avatars <= 0 <= total_combos:
+    while not 0 < num_avatars <= total_combos:
         try:
             num_avatars = int(input())
         except ValueError:
             continue
-    if prev_data:
-        num_avatars += existing_amount
     print()
 
-    paths = generate_paths(version_path, edition_name)
-
     print('\nStarting task...')
 
     print('\nCreating directory...')
     create_dir(paths['edition'])
 
+    # Only the new avatars are generated,
+    # existing ones are only looked up through the uniqueness index
     print('\nGenerating image data...')
-    all_data = generate_asset_data(version_path, edition_config,
-                                   num_avatars, prev_data)
-    csv_data = [data[0] for data in all_data]
-    json_data = {i + 1: data for i, data
-                 in enumerate([data[1] for data in all_data])}
-
-    print('\nCreating trait rarity table...\n')
-    create_csv(create_csv_data(edition_config, csv_data), paths['csv'])
-    create_assets_json(json_data, paths['json'])
+    with instrument.stage('generate', paths) as record:
+        new_traits = generate_trait_indices(edition_config, num_avatars,
+                                            unique_index, edition_seed)
+        record.items = len(new_traits)
+
+    print('\nSaving edition...\n')
+    traits = np.concatenate([traits, new_traits])
+    ranks = None
+    if get_total_combinations(edition_config) < 2 ** 63:
+        ranks = unique_index.ranks()
+    save_edition_state(paths, edition_config, traits, ranks, edition_seed)
+    update_exports(paths, EDITION_EXPORTS, existing_amount)
 
     return edition_name
 
@@ -0,0 +1,310 @@
+import argparse
+from contextlib import contextmanager
+import json
+import os
+import platform
+import sys
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from assets import (generate_asset_data, generate_trait_indices, parse_config,
+                    UniqueIndex)
+from config import (ASSETS_PATH, BENCHMARK_SIZES, BENCHMARK_TOLERANCE,
+                    METADATA_FORMAT, RARITY_TABLE_PATH, RENDER_WORKERS)
+from edition import EditionSeed, save_edition_state
+from encoding import get_edition_profile
+from images import generate_images
+from metadata import create_metadata_files
+from randomizer import create_random_groups
+from rarity_table import create_table_rows
+from utils import create_csv, erase_dir, erase_edition, generate_paths
+
+# Benchmark of every stage of the tool on synthetic assets.
+# The assets are drawn procedurally from a seed, so the same version folder
+# can be recreated anywhere without sharing real artwork.
+# Results are saved as json:
+# {'version': BENCHMARK_VERSION, 'machine': {...}, 'seed': seed,
+#  'results': {edition size: {stage: best time in seconds}}}
+# and compared against a baseline saved the same way
+
+BENCHMARK_VERSION = 1
+STAGES = ('generate', 'images', 'groups', 'metadata')
+# Synthetic layers as (name, number of traits, required)
+SYNTHETIC_LAYERS = [('Background', 10, True), ('Body', 12, True),
+                    ('Eyes', 16, True), ('Mouth', 12, True),
+                    ('Hat', 10, False), ('Accessory', 8, False)]
+# Changes smaller than this many seconds are never regressions,
+# whatever the tolerance
+MIN_REGRESSION = 0.05
+
+
+# Draw a trait image. Every layer covers its own region of the canvas,
+# upper layers are partly translucent so compositing does real blending
+def draw_trait(layer: int, size: int, rng: np.random.Generator) -> Image.Image:
+    color = tuple(int(c) for c in rng.integers(0, 256, 3))
+    if layer == 0:
+        top = np.array(color, dtype=np.float64)
+        bottom = rng.integers(0, 256, 3).astype(np.float64)
+        t = np.linspace(0, 1, size)[:, None, None]
+        pixels = np.broadcast_to(top * (1 - t) + bottom * t, (size, size, 3))
+        return Image.fromarray(pixels.astype(np.uint8), 'RGB').convert('RGBA')
+
+    img = Image.new('RGBA', (size, size), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    alpha = int(rng.integers(160, 256))
+    fill = color + (alpha,)
+    s = size / 16
+    jitter = float(rng.uniform(-s, s))
+    if layer == 1:
+        draw.ellipse([3 * s + jitter, 4 * s, 13 * s - jitter, 16 * s],
+                     fill=fill)
+    elif layer == 2:
+        radius = float(rng.uniform(0.6, 1.4)) * s
+        for x in (6 * s, 10 * s):
+            draw.ellipse([x - radius, 7 * s - radius + jitter,
+                          x + radius, 7 * s + radius + jitter], fill=fill)
+    elif layer == 3:
+        draw.rectangle([6 * s + jitter, 10 * s, 10 * s - jitter, 11 * s],
+                       fill=fill)
+    elif layer == 4:
+        draw.polygon([(3 * s, 5 * s), (13 * s, 5 * s),
+                      (8 * s + jitter, float(rng.uniform(0, 2)) * s)],
+                     fill=fill)
+    else:
+        x, y = rng.uniform(2 * s, 14 * s, 2)
+        draw.rectangle([x - s, y - s, x + s, y + s], fill=fill)
+    return img
+
+
+# Write the layer folders of a synthetic version and its rarity table,
+# with random weights in the format extract_rarity_from_csv expects
+def create_synthetic_version(version_path: str, image_size: int = 128,
+                             seed: int = 0,
+                             layers: List[Tuple[str, int, bool]] = (
+                                 SYNTHETIC_LAYERS)) -> None:
+    rng = np.random.default_rng(seed)
+    assets_path = os.path.join(version_path, ASSETS_PATH)
+    if os.path.exists(assets_path):
+        erase_dir(assets_path)
+    # The rarity table takes layer ids from numbered folder names
+    numbered = [f'{i} {name}' for i, (name, _, _) in enumerate(layers, 1)]
+    for i, ((name, count, _), folder) in enumerate(zip(layers, numbered)):
+        layer_path = os.path.join(assets_path, folder)
+        os.makedirs(layer_path)
+        for n in range(1, count + 1):
+            draw_trait(i, image_size, rng).save(
+                os.path.join(layer_path, f'{name.lower()}-{n}.png'))
+
+    rows = create_table_rows(version_path)
+    # create_table_rows lists the layer folders in directory order
+    order = [numbered.index(folder)
+             for folder in os.listdir(assets_path)]
+    for n, i in enumerate(order):
+        _, count, required = layers[i]
+        for row in rows[2:2 + count]:
+            row[n * 4 + 2] = int(rng.integers(1, 100))
+        if not required:
+            rows[2 + count][n * 4 + 2] = int(rng.integers(10, 100))
+    create_csv(rows, os.path.join(version_path, RARITY_TABLE_PATH))
+    for (name, _, _), folder in zip(layers, numbered):
+        os.rename(os.path.join(assets_path, folder),
+                  os.path.join(assets_path, name))
+
+
+def synthetic_version_exists(version_path: str) -> bool:
+    return os.path.exists(os.path.join(version_path, RARITY_TABLE_PATH))
+
+
+# Silence the progress bars and messages of the stages being timed.
+# Progress bars keep their own reference to the streams, so the file
+# descriptors themselves are redirected
+@contextmanager
+def quiet() -> Iterator[None]:
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    try:
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in saved + [devnull]:
+            os.close(fd)
+
+
+def time_call(func: Callable[..., Any], *args: Any, **kwargs: Any) -> float:
+    start = time.perf_counter()
+    with quiet():
+        func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+# Run every stage once on a new edition of the given size.
+# Returns the time each stage took in seconds
+def run_stages(version_path: str, size: int, stages: List[str], seed: int,
+               workers: Optional[int] = RENDER_WORKERS) -> Dict[str, float]:
+    edition_name = f'benchmark {size}'
+    paths = generate_paths(version_path, edition_name)
+    with quiet():
+        if os.path.exists(paths['edition']):
+            erase_edition(version_path, edition_name)
+        edition_config = parse_config(version_path)
+
+    timings = {}
+    if 'generate' in stages:
+        timings['generate'] = time_call(generate_asset_data, edition_config,
+                                        size, seed=EditionSeed(seed))
+    # The stages below need the edition saved, the same seed gives the
+    # same trait sets as the timed run
+    edition_seed = EditionSeed(seed)
+    unique_index = UniqueIndex(edition_config)
+    with quiet():
+        traits = generate_trait_indices(edition_config, size, unique_index,
+                                        edition_seed)
+    os.makedirs(paths['edition'])
+    save_edition_state(paths, edition_config, traits, unique_index.ranks(),
+                       edition_seed)
+
+    if 'images' in stages:
+        profile = get_edition_profile(paths)
+        timings['images'] = time_call(generate_images, paths, len(str(size)),
+                                      workers, profile)
+    if 'groups' in stages:
+        timings['groups'] = time_call(create_random_groups, version_path,
+                                      edition_name)
+    if 'metadata' in stages:
+        timings['metadata'] = time_call(create_metadata_files, version_path,
+                                        edition_name, METADATA_FORMAT, False)
+    with quiet():
+        erase_edition(version_path, edition_name)
+    return timings
+
+
+def get_machine() -> Dict[str, Any]:
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpus': os.cpu_count()}
+
+
+# Benchmark every edition size, keeping the best time of each stage
+def run_benchmark(version_path: str, sizes: List[int], stages: List[str],
+                  repeat: int = 1, seed: int = 0, image_size: int = 128,
+                  workers: Optional[int] = RENDER_WORKERS
+                  ) -> Dict[str, Any]:
+    if not synthetic_version_exists(version_path):
+        print(f'Creating synthetic assets in {version_path}')
+        create_synthetic_version(version_path, image_size, seed)
+
+    results = {}
+    for size in sizes:
+        best: Dict[str, float] = {}
+        for _ in range(repeat):
+            timings = run_stages(version_path, size, stages, seed, workers)
+            for stage, seconds in timings.items():
+                best[stage] = min(seconds, best.get(stage, seconds))
+        results[str(size)] = best
+        print(f'{size:>8} ' + '  '.join(f'{stage} {seconds:.3f}s'
+                                       for stage, seconds in best.items()))
+    return {'version': BENCHMARK_VERSION, 'machine': get_machine(),
+            'seed': seed, 'results': results}
+
+
+def load_results(path: str) -> Dict[str, Any]:
+    with open(path, 'r') as file:
+        results = json.load(file)
+    if results.get('version') != BENCHMARK_VERSION:
+        raise ValueError(f'{path} was saved by another benchmark version')
+    return results
+
+
+def save_results(path: str, results: Dict[str, Any]) -> None:
+    with open(path, 'w') as file:
+        json.dump(results, file, indent=2)
+
+
+# Compare results against a baseline, stage by stage.
+# Returns the (size, stage) pairs that got slower than the tolerance allows
+def compare_results(results: Dict[str, Any], baseline: Dict[str, Any],
+                    tolerance: float = BENCHMARK_TOLERANCE
+                    ) -> List[Tuple[str, str]]:
+    if results['machine'] != baseline['machine']:
+        print('Warning: the baseline was measured on another machine')
+    regressions = []
+    print(f'{"Size":>8}  {"Stage":<10}{"Baseline":>10}{"Current":>10}'
+          f'{"Change":>9}')
+    for size, timings in results['results'].items():
+        for stage, seconds in timings.items():
+            base = baseline['results'].get(size, {}).get(stage)
+            if base is None:
+                continue
+            change = seconds / base - 1 if base else 0.0
+            slower = (change > tolerance
+                      and seconds - base > MIN_REGRESSION)
+            if slower:
+                regressions.append((size, stage))
+            print(f'{size:>8}  {stage:<10}{base:>9.3f}s{seconds:>9.3f}s'
+                  f'{change:>+9.1%}{"  REGRESSION" if slower else ""}')
+    return regressions
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Time every stage on synthetic assets and compare'
+                    ' against a baseline')
+    parser.add_argument('version',
+                        help='path of the synthetic version folder,'
+                             ' created if it has no rarity table')
+    parser.add_argument('-n', '--sizes',
+                        default=','.join(map(str, BENCHMARK_SIZES)),
+                        help='comma separated edition sizes')
+    parser.add_argument('-s', '--stages', default=','.join(STAGES),
+                        help='comma separated stages to time, out of'
+                             f' {", ".join(STAGES)} (default: all)')
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help='runs per size, the best time is kept')
+    parser.add_argument('-w', '--workers', type=int, default=RENDER_WORKERS,
+                        help='number of render processes')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the synthetic assets and editions')
+    parser.add_argument('--image-size', type=int, default=128,
+                        help='width and height of the synthetic assets')
+    parser.add_argument('-o', '--output', default='benchmark.json',
+                        help='where the results are saved')
+    parser.add_argument('-b', '--baseline',
+                        help='results to compare against')
+    parser.add_argument('-t', '--tolerance', type=float,
+                        default=BENCHMARK_TOLERANCE,
+                        help='slowdown allowed before a stage is flagged,'
+                             ' as a fraction of the baseline')
+    args = parser.parse_args()
+    args.sizes = [int(size) for size in args.sizes.split(',')]
+    args.stages = [stage.strip() for stage in args.stages.split(',')]
+    for stage in args.stages:
+        if stage not in STAGES:
+            parser.error(f'unknown stage `{stage}`')
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    results = run_benchmark(os.path.abspath(args.version), args.sizes,
+                            args.stages, args.repeat, args.seed,
+                            args.image_size, args.workers)
+    save_results(args.output, results)
+    print(f'Results saved to {args.output}')
+    if args.baseline:
+        regressions = compare_results(results, load_results(args.baseline),
+                                      args.tolerance)
+        if regressions:
+            print(f'{len(regressions)} stages got slower')
+            raise SystemExit(1)
+        print('No regressions')
@@ -0,0 +1,202 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+from io import BytesIO
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from PIL import Image
+from progressbar import ProgressBar
+
+from config import ASSETS_PATH, CATALOG_PATH
+from utils import atomic_write, CONFIG_DICT
+
+# The asset catalog records what every trait image of a version looks like,
+# so the images are only decoded again once they change. It is saved in the
+# version folder:
+# {'version': CATALOG_VERSION,
+#  'layers': {layer name: {'mtime': mtime of the layer folder,
+#                          'traits': {file name: trait info}}}}
+# A layer folder is only listed again when its mtime changes, and a trait
+# image only inspected again when its mtime or size changes.
+# Trait info holds the image's mtime, size, width, height, alpha bounding
+# box as [left, top, right, bottom] (None if fully transparent), opacity
+# class and sha256, or an error if the image cannot be read.
+# Renderers look trait images up in the catalog, so they know which part of
+# a layer to blend without scanning its pixels.
+# Opacity classes:
+# - opaque: every pixel is fully opaque
+# - binary: pixels are either fully opaque or fully transparent
+# - translucent: some pixels are partially transparent
+# - empty: every pixel is fully transparent
+
+CATALOG_VERSION = 1
+TraitInfo = Dict[str, Any]
+
+# Catalogs read by renderers, by path, along with their mtime
+loaded_catalogs: Dict[str, Tuple[int, Dict[str, Any]]] = {}
+
+
+def get_opacity_class(alpha: Image.Image) -> str:
+    low, high = alpha.getextrema()
+    if high == 0:
+        return 'empty'
+    if low == 255:
+        return 'opaque'
+    if sum(alpha.histogram()[1:255]):
+        return 'translucent'
+    return 'binary'
+
+
+# Read and decode a trait image once to record everything about it
+def inspect_image(path: str) -> TraitInfo:
+    stat = os.stat(path)
+    info = {'mtime': stat.st_mtime_ns, 'size': stat.st_size}
+    try:
+        with open(path, 'rb') as file:
+            data = file.read()
+        with Image.open(BytesIO(data)) as img:
+            img.load()
+            alpha = img.convert('RGBA').getchannel('A')
+            bbox = alpha.getbbox()
+            info.update(width=img.width, height=img.height,
+                        bbox=list(bbox) if bbox else None,
+                        opacity=get_opacity_class(alpha),
+                        sha256=hashlib.sha256(data).hexdigest())
+    except Image.UnidentifiedImageError:
+        info['error'] = 'not a readable image'
+    except OSError as e:
+        info['error'] = str(e) or type(e).__name__
+    return info
+
+
+def load_catalog(path: str) -> Dict[str, Any]:
+    try:
+        with open(path, 'r') as file:
+            catalog = json.load(file)
+    except (FileNotFoundError, ValueError):
+        return {}
+    return catalog if catalog.get('version') == CATALOG_VERSION else {}
+
+
+def save_catalog(path: str, catalog: Dict[str, Any]) -> None:
+    with atomic_write(path) as file:
+        json.dump(catalog, file)
+
+
+# Get the trait images of a layer folder and the ones that need inspecting.
+# Cached trait info is kept for images that did not change
+def scan_layer(layer_path: str, cached: Optional[Dict[str, Any]]
+               ) -> Tuple[Dict[str, Any], List[str]]:
+    mtime = os.stat(layer_path).st_mtime_ns
+    cached = cached or {'mtime': None, 'traits': {}}
+    if cached['mtime'] == mtime:
+        names = list(cached['traits'])
+    else:
+        names = sorted(name for name in os.listdir(layer_path)
+                       if name[0] != '.')
+
+    traits, stale = {}, []
+    for name in names:
+        info = cached['traits'].get(name)
+        try:
+            stat = os.stat(os.path.join(layer_path, name))
+        except FileNotFoundError:
+            # Removed without the folder being listed again
+            return scan_layer(layer_path, None)
+        if (info is None or info['mtime'] != stat.st_mtime_ns
+                or info['size'] != stat.st_size):
+            stale.append(name)
+        traits[name] = info
+    return {'mtime': mtime, 'traits': traits}, stale
+
+
+# Bring the catalog of a version up to date and return the trait info of
+# every layer, inspecting new and changed images in parallel
+def update_catalog(version_path: str,
+                   layer_names: List[str]) -> Dict[str, Dict[str, TraitInfo]]:
+    path = os.path.join(version_path, CATALOG_PATH)
+    catalog = load_catalog(path)
+    cached_layers = catalog.get('layers', {})
+
+    layers, stale = {}, []
+    for layer_name in layer_names:
+        layer_path = os.path.join(version_path, ASSETS_PATH, layer_name)
+        layers[layer_name], names = scan_layer(
+            layer_path, cached_layers.get(layer_name))
+        stale.extend((layer_name, os.path.join(layer_path, name), name)
+                     for name in names)
+
+    if stale:
+        print(f'Inspecting {len(stale)} trait images')
+        bar = ProgressBar(max_value=len(stale)).start()
+        with ThreadPoolExecutor() as executor:
+            for done, ((layer_name, _, name), info) in enumerate(zip(
+                    stale, executor.map(inspect_image,
+                                        [path for _, path, _ in stale])),
+                    start=1):
+                layers[layer_name]['traits'][name] = info
+                bar.update(done)
+        bar.finish()
+        print()
+
+    if stale or any(layer != cached_layers.get(name)
+                    for name, layer in layers.items()):
+        save_catalog(path, {'version': CATALOG_VERSION,
+                            'layers': {**cached_layers, **layers}})
+    return {name: layer['traits'] for name, layer in layers.items()}
+
+
+# Get the catalog's info about a trait image from its path, None if the
+# image is not in the catalog, cannot be read or changed since it was
+# inspected. Catalogs are read once per process and again when they change
+def get_trait_info(path: str) -> Optional[TraitInfo]:
+    layer_path, name = os.path.split(path)
+    assets_path, layer_name = os.path.split(layer_path)
+    if not assets_path.endswith(ASSETS_PATH):
+        return None
+    catalog_path = os.path.join(assets_path[:-len(ASSETS_PATH)],
+                                CATALOG_PATH)
+    try:
+        mtime = os.stat(catalog_path).st_mtime_ns
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    if loaded_catalogs.get(catalog_path, (None,))[0] != mtime:
+        loaded_catalogs[catalog_path] = (mtime, load_catalog(catalog_path))
+    layer = loaded_catalogs[catalog_path][1].get('layers', {}).get(layer_name)
+    info = layer['traits'].get(name) if layer else None
+    if (info is None or 'error' in info or info['mtime'] != stat.st_mtime_ns
+            or info['size'] != stat.st_size):
+        return None
+    return info
+
+
+# Check every trait image before anything is generated or rendered.
+# Unreadable images and images whose size differs from the others are
+# errors. Fully transparent images are only reported
+def preflight_assets(edition_config: CONFIG_DICT) -> None:
+    entries = [(layer['name'], name, info)
+               for layer in edition_config
+               for name, info in zip(layer['traits'], layer['assets'])
+               if info is not None]
+    errors = [f'{layer}/{name}: {info["error"]}'
+              for layer, name, info in entries if 'error' in info]
+    readable = [entry for entry in entries if 'error' not in entry[2]]
+
+    sizes = Counter((info['width'], info['height'])
+                    for _, _, info in readable)
+    if sizes:
+        (width, height), _ = sizes.most_common(1)[0]
+        errors.extend(f'{layer}/{name}: {info["width"]}x{info["height"]}'
+                      f' instead of {width}x{height}'
+                      for layer, name, info in readable
+                      if (info['width'], info['height']) != (width, height))
+    if errors:
+        raise ValueError('Some trait images cannot be used:\n'
+                         + '\n'.join(errors))
+
+    for layer, name, info in readable:
+        if info['opacity'] == 'empty':
+            print(f'Warning: {layer}/{name} is fully transparent')
@@ -0,0 +1,357 @@
+from collections import OrderedDict
+from itertools import islice
+import os
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from catalog import get_trait_info
+from config import COMPOSITE_BACKEND, LAYER_CACHE_SIZE
+from edition import load_edition_data
+import instrument
+from utils import choose_edition, choose_version, generate_paths
+
+
+# Least recently used cache of decoded layers, bounded by size in bytes.
+# Layers are keyed by path and modification time so edited layers reload,
+# and by whether they are used as the background of an image.
+# `load` returns the decoded layer along with its size in bytes
+class LayerCache:
+    def __init__(self, max_size: int,
+                 load: Callable[[str, bool], Tuple[Any, int]]) -> None:
+        self.max_size = max_size
+        self.load = load
+        self.size = 0
+        self.layers: OrderedDict[Tuple[str, float, bool], Tuple[Any, int]] = (
+            OrderedDict())
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, path: str, background: bool = False) -> Any:
+        key = (path, os.path.getmtime(path), background)
+        entry = self.layers.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.layers.move_to_end(key)
+            return entry[0]
+
+        self.misses += 1
+        with instrument.timer('render.decode'):
+            entry = self.load(path, background)
+        self.layers[key] = entry
+        self.size += entry[1]
+        while self.size > self.max_size and len(self.layers) > 1:
+            _, (_, size) = self.layers.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+        return entry[0]
+
+    def clear(self) -> None:
+        self.layers.clear()
+        self.size = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'layers': len(self.layers),
+                'bytes': self.size}
+
+
+# Decode a layer image, normalized to RGBA, along with its own mode
+def load_image(path: str) -> Tuple[Image.Image, str]:
+    with Image.open(path) as file:
+        return file.convert('RGBA'), file.mode
+
+
+# Backgrounds keep their own mode, which is the mode of the final image
+def load_pil_layer(path: str, background: bool) -> Tuple[Image.Image, int]:
+    if background:
+        with Image.open(path) as file:
+            file.load()
+            img = file.copy()
+    else:
+        img = load_image(path)[0]
+    return img, img.width * img.height * len(img.getbands())
+
+
+def paste_pil_layer(canvas: Image.Image, img: Image.Image) -> None:
+    canvas.paste(img, (0,0), img)
+
+
+# A decoded layer prepared for blending with numpy.
+# Only the bounding box of its non-transparent pixels is ever touched,
+# so only that region is kept, along with the shape of the whole layer.
+# Background layers also keep all their pixels (`pixels`) to start from,
+# and the mode of the image they were decoded from (`mode`), which is the
+# mode of the final image.
+# `bands` splits the box into runs of rows: fully opaque runs are copied
+# as a block (mask is None), other runs copy their opaque pixels through a
+# mask, and fully transparent runs are left out. Only partially
+# transparent pixels (listed by `partial`) go through the blending math
+class LayerArray(NamedTuple):
+    mode: str
+    shape: Tuple[int, ...]
+    pixels: Optional[np.ndarray]
+    region: np.ndarray
+    box: Optional[Tuple[int, int, int, int]]
+    bands: List[Tuple[int, int, Optional[np.ndarray]]]
+    partial: Tuple[np.ndarray, np.ndarray]
+    partial_pixels: np.ndarray
+    partial_alpha: np.ndarray
+
+
+# View RGBA pixels as one 32 bit integer per pixel for faster copies
+def as_pixels32(pixels: np.ndarray) -> np.ndarray:
+    return pixels.view(np.uint32)[..., 0]
+
+
+def get_row_bands(opaque: np.ndarray, transparent: np.ndarray
+                  ) -> List[Tuple[int, int, Optional[np.ndarray]]]:
+    kinds = np.where(opaque.all(axis=1), 1,
+                     np.where(transparent.all(axis=1), 0, 2))
+    edges = np.flatnonzero(np.diff(kinds)) + 1
+    bands = []
+    for start, end in zip(np.r_[0, edges], np.r_[edges, len(kinds)]):
+        if kinds[start] == 1:
+            bands.append((start, end, None))
+        elif kinds[start] == 2:
+            bands.append((start, end, opaque[start:end]))
+    return bands
+
+
+def get_empty_layer(mode: str, shape: Tuple[int, ...],
+                    pixels: Optional[np.ndarray]) -> LayerArray:
+    empty = np.empty(0, dtype=np.intp)
+    return LayerArray(mode, shape, pixels, np.empty((0, 0, 4), dtype=np.uint8),
+                      None, [], (empty, empty),
+                      np.empty((0, 4), dtype=np.uint16),
+                      np.empty((0, 1), dtype=np.uint16))
+
+
+# Get the bounding box of the non-transparent pixels of a layer as
+# (top, left, bottom, right), None if it is fully transparent
+def get_layer_box(pixels: np.ndarray) -> Optional[Tuple[int, int, int, int]]:
+    alpha = pixels[..., 3]
+    rows = np.flatnonzero(alpha.any(axis=1))
+    cols = np.flatnonzero(alpha.any(axis=0))
+    if not len(rows):
+        return None
+    return rows[0], cols[0], rows[-1] + 1, cols[-1] + 1
+
+
+# Decode a layer and prepare it for blending. The bounding box and opacity
+# class come from the asset catalog when it knows the image, so fully
+# transparent layers are not even decoded and opaque ones are not scanned
+def load_array_layer(path: str, background: bool) -> Tuple[LayerArray, int]:
+    info = get_trait_info(path)
+    if info is not None and info['bbox'] is None and not background:
+        return get_empty_layer('RGBA', (info['height'], info['width'], 4),
+                               None), 0
+
+    img, mode = load_image(path)
+    pixels = np.ascontiguousarray(img)
+    kept = pixels if background else None
+    kept_size = pixels.nbytes if background else 0
+    if info is None:
+        box, opacity = get_layer_box(pixels), None
+    else:
+        box, opacity = None, info['opacity']
+        if info['bbox'] is not None:
+            left, top, right, bottom = info['bbox']
+            box = top, left, bottom, right
+    if box is None:
+        return get_empty_layer(mode, pixels.shape, kept), kept_size
+
+    top, left, bottom, right = box
+    # Copy the region so the rest of the decoded layer can be freed
+    region = pixels[top:bottom, left:right].copy()
+    if opacity == 'opaque':
+        bands = [(0, len(region), None)]
+        partial = (np.empty(0, dtype=np.intp),) * 2
+    else:
+        region_alpha = region[..., 3]
+        opaque = region_alpha == 255
+        transparent = region_alpha == 0
+        bands = get_row_bands(opaque, transparent)
+        if opacity == 'binary':
+            partial = (np.empty(0, dtype=np.intp),) * 2
+        else:
+            partial = np.nonzero(~(opaque | transparent))
+    layer = LayerArray(
+        mode, pixels.shape, kept, region, box, bands, partial,
+        region[partial].astype(np.uint16),
+        region[partial][:, 3:].astype(np.uint16))
+    size = (kept_size + region.nbytes
+            + sum(mask.nbytes for _, _, mask in layer.bands
+                  if mask is not None)
+            + layer.partial_pixels.nbytes + layer.partial_alpha.nbytes
+            + 2 * partial[0].nbytes)
+    return layer, size
+
+
+def get_array_base(layer: LayerArray) -> np.ndarray:
+    return layer.pixels.copy()
+
+
+# Blend a layer onto the canvas the same way PIL pastes an RGBA image
+# using itself as the mask, so the result is pixel-identical
+def paste_array_layer(canvas: np.ndarray, layer: LayerArray) -> None:
+    if layer.box is None:
+        # Fully transparent, nothing to do
+        return
+    if layer.shape != canvas.shape:
+        raise ValueError('All layers must be the same size as the background')
+
+    top, left, bottom, right = layer.box
+    region = as_pixels32(canvas)[top:bottom, left:right]
+    src = as_pixels32(layer.region)
+    for start, end, mask in layer.bands:
+        if mask is None:
+            region[start:end] = src[start:end]
+        else:
+            np.copyto(region[start:end], src[start:end], where=mask)
+
+    if len(layer.partial[0]):
+        # out = (dst * (255 - a) + src * a) / 255, rounded like PIL does
+        region = canvas[top:bottom, left:right]
+        alpha = layer.partial_alpha
+        blend = (region[layer.partial].astype(np.uint16) * (255 - alpha)
+                 + layer.partial_pixels * alpha + 128)
+        region[layer.partial] = ((blend >> 8) + blend) >> 8
+
+
+def array_to_image(canvas: np.ndarray) -> Image.Image:
+    return Image.fromarray(canvas, 'RGBA')
+
+
+# Everything a compositing backend needs to stack layers
+class Backend(NamedTuple):
+    cache: LayerCache
+    # Turn a cached layer into a canvas that is safe to paste onto
+    base: Callable[[Any], Any]
+    copy: Callable[[Any], Any]
+    paste: Callable[[Any, Any], None]
+    to_image: Callable[[Any], Image.Image]
+    # Mode of the final image, from its background layer
+    mode: Callable[[Any], str]
+
+
+# Each backend has its own cache, shared by every image of this process
+BACKENDS = {
+    'pil': Backend(LayerCache(LAYER_CACHE_SIZE, load_pil_layer),
+                   lambda img: img.copy(), lambda img: img.copy(),
+                   paste_pil_layer, lambda img: img, lambda img: img.mode),
+    'numpy': Backend(LayerCache(LAYER_CACHE_SIZE, load_array_layer),
+                     get_array_base, np.copy, paste_array_layer,
+                     array_to_image, lambda layer: layer.mode),
+}
+
+
+def get_backend(name: str = COMPOSITE_BACKEND) -> Backend:
+    try:
+        return BACKENDS[name]
+    except KeyError:
+        raise ValueError(f'Unknown compositing backend `{name}`') from None
+
+
+# Stack layers on top of one another. The image has the mode of its
+# background, as if every layer was pasted onto the background itself.
+# `prefixes` holds (filepath, composite of all layers up to it, mode)
+# entries of the previous image, so layers shared with it are not
+# composited again
+def composite_layers(filepaths: List[str],
+                     prefixes: Optional[List[Tuple[str, Any, str]]] = None,
+                     backend: str = COMPOSITE_BACKEND) -> Image.Image:
+    compositor = get_backend(backend)
+    if prefixes is None:
+        prefixes = []
+    layers = [filepaths[0]] + [filepath for filepath in filepaths[1:]
+                               if filepath.endswith('.png')]
+
+    # Drop the composites that are not shared with this image
+    shared = 0
+    while (shared < min(len(prefixes), len(layers))
+           and prefixes[shared][0] == layers[shared]):
+        shared += 1
+    del prefixes[shared:]
+
+    for filepath in layers[shared:]:
+        layer = compositor.cache.get(os.path.join('assets', filepath),
+                                     not prefixes)
+        if prefixes:
+            # Cached layers and prefixes are shared, so paste onto a copy
+            canvas = compositor.copy(prefixes[-1][1])
+            compositor.paste(canvas, layer)
+            mode = prefixes[-1][2]
+        else:
+            # Treat the first layer as the background
+            canvas = compositor.base(layer)
+            mode = compositor.mode(layer)
+        prefixes.append((filepath, canvas, mode))
+    img = compositor.to_image(prefixes[-1][1])
+    # Composites are made in RGBA whatever the background's mode
+    return img if img.mode == prefixes[-1][2] else img.convert(
+        prefixes[-1][2])
+
+
+def time_paste(paste: Callable[[Any, Any], None], canvas: Any, layer: Any,
+               repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        paste(canvas, layer)
+    return (time.perf_counter() - start) / repeat
+
+
+# Time every layer of an image with each backend and make sure they agree
+def benchmark_layers(filepaths: List[str], repeat: int = 20) -> None:
+    pil, array = get_backend('pil'), get_backend('numpy')
+    layers = [filepaths[0]] + [filepath for filepath in filepaths[1:]
+                               if filepath.endswith('.png')]
+    background = pil.cache.get(layers[0], True)
+    pil_canvas = pil.base(background)
+    array_canvas = array.base(array.cache.get(layers[0], True))
+    total_pil = total_array = 0
+
+    print(f'{"Layer":<40}{"Box":>8}{"PIL ms":>10}{"NumPy ms":>10}'
+          f'{"Speedup":>9}')
+    for filepath in layers[1:]:
+        img, layer = pil.cache.get(filepath), array.cache.get(filepath)
+        pil_time = time_paste(pil.paste, pil_canvas.copy(), img, repeat)
+        array_time = time_paste(array.paste, array_canvas.copy(), layer,
+                                repeat)
+        pil.paste(pil_canvas, img)
+        array.paste(array_canvas, layer)
+        if not np.array_equal(np.asarray(pil_canvas), np.asarray(
+                array.to_image(array_canvas).convert(background.mode))):
+            raise AssertionError(f'Backends disagree on {filepath}')
+
+        coverage = 0.0
+        if layer.box is not None:
+            top, left, bottom, right = layer.box
+            coverage = ((bottom - top) * (right - left)
+                        / (layer.shape[0] * layer.shape[1]))
+        total_pil += pil_time
+        total_array += array_time
+        print(f'{os.path.basename(filepath)[-40:]:<40}{coverage:>8.1%}'
+              f'{pil_time * 1000:>10.3f}{array_time * 1000:>10.3f}'
+              f'{pil_time / max(array_time, 1e-9):>8.1f}x')
+    print(f'{"Total":<48}{total_pil * 1000:>10.3f}{total_array * 1000:>10.3f}'
+          f'{total_pil / max(total_array, 1e-9):>8.1f}x')
+
+
+def benchmark_edition(version_path: str, edition_name: Optional[str] = None,
+                      samples: int = 5) -> None:
+    if edition_name is None:
+        edition_name = choose_edition(version_path)
+
+    if edition_name:
+        all_data = load_edition_data(generate_paths(version_path,
+                                                    edition_name))
+        for i, filepaths in islice(all_data.items(), samples):
+            print(f'\nImage {i}')
+            benchmark_layers(filepaths)
+
+
+if __name__ == '__main__':
+    benchmark_edition(choose_version())
+    print('Task complete!')
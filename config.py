@@ -26,6 +26,10 @@ ASSETS_PATH = 'assets'
 # Base metadata. MUST BE EDITED.
 BASE_IMAGE_URL = "ipfs://<-- Your CID Code-->"
 BASE_NAME = ""
+# Give every item the ipfs URI of its own image, computed locally from the
+# rendered file (see manifest.py), instead of BASE_IMAGE_URL and its name.
+# Metadata can then only be written once the images are rendered
+CONTENT_ADDRESSED_IMAGES = False
 
 BASE_JSON = {
     "name": BASE_NAME,
@@ -34,5 +38,75 @@ BASE_JSON = {
     "attributes": [],
 }
 RANDOMIZED_GROUP_SIZE = 10
+# Also create a folder per group with hard links to its images.
+# Groups are always recorded in the edition's groups.json
+MATERIALIZE_GROUPS = False
 RARITY_TABLE_PATH = 'rarity table.csv'
+# Cached information about every trait image, see catalog.py
+CATALOG_PATH = 'catalog.json'
+# Trait constraints, see constraints.py for the file format
+CONSTRAINTS_PATH = 'constraints.csv'
 RARITY_BY_PERCENTAGE = False
+# Number of candidates drawn from each random stream when generating trait
+# sets. Changing it changes the edition a given seed produces
+SAMPLING_BATCH_SIZE = 65536
+# Number of processes drawing candidates. None uses every available core
+GENERATION_WORKERS = None
+# Formats the items of an edition are exported to whenever it is created or
+# extended, out of 'csv' (assets.csv) and 'json' (assets.json).
+# Editions are stored in a compact format that does not need them
+EDITION_EXPORTS = ()
+# Seed of new editions, None picks a random one.
+# The seed is recorded with the edition so it can be reproduced
+EDITION_SEED = None
+# Share of all combinations above which they are enumerated and sampled
+# directly instead of drawn at random and rejected when taken
+RANKED_SAMPLING_THRESHOLD = 0.5
+# Most combinations sampled directly, all of which are held in memory.
+# Editions with more valid combinations are always drawn at random
+RANKED_SAMPLING_LIMIT = 2 ** 22
+# Layer compositing backend: 'numpy' blends only the visible part of each
+# layer, 'pil' pastes whole layers. Both produce identical images
+COMPOSITE_BACKEND = 'numpy'
+# Maximum memory in bytes used to keep decoded layer images around.
+# Render processes each keep their own layers, within an equal share of it
+LAYER_CACHE_SIZE = 1024 ** 3
+# Number of processes rendering images. None uses every available core
+RENDER_WORKERS = None
+# Number of images handed to a rendering process at a time
+RENDER_CHUNK_SIZE = 32
+# How rendered images are encoded, see encoding.py for the options.
+# The profile is recorded in the edition folder on first use
+ENCODING_PROFILE = 'png'
+# Smaller sizes rendered along with every full size image, as
+# (width, encoding profile) pairs, e.g. ((512, None), (128, 'webp-lossless')).
+# Images of each width are saved in an `images <width>` folder of the edition.
+# A profile of None uses the edition's profile
+IMAGE_VARIANTS = ()
+# Metadata output: 'files' writes one json file per item, 'jsonl' a single
+# file with one item per line and 'zip' a single archive of json files
+METADATA_FORMAT = 'files'
+# Number of threads writing metadata files
+METADATA_WORKERS = 8
+# Contact sheets: width and height of a tile, tiles per row and rows per
+# sheet, and number of threads decoding tiles
+CONTACT_SHEET_TILE_SIZE = 128
+CONTACT_SHEET_COLUMNS = 16
+CONTACT_SHEET_ROWS = 16
+CONTACT_SHEET_WORKERS = 8
+# Rarity graphs: most points drawn on the score curve and histogram bins
+GRAPH_MAX_POINTS = 2000
+GRAPH_BINS = 50
+# Record timers and counters in the hot paths and save a report of every
+# run in the edition folder, see instrument.py
+INSTRUMENTATION = False
+# Stage run under the sampling profiler when instrumentation is on,
+# out of 'generate', 'images', 'groups', 'metadata' and 'pipeline'
+PROFILE_STAGE = None
+# Seconds between two samples of the profiler
+PROFILE_INTERVAL = 0.005
+# Edition sizes timed by benchmark.py
+BENCHMARK_SIZES = (1000, 10000, 100000)
+# Slowdown against the baseline above which benchmark.py flags a stage,
+# as a fraction of the baseline time
+BENCHMARK_TOLERANCE = 0.1
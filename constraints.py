@@ -0,0 +1,238 @@
+# Trait constraints are declared per version in a csv file placed next to
+# the rarity table. Each row has the following columns:
+# 1. Rule: One of the rules below.
+# 2. Layer: The name of the layer the rule is about.
+# 3. Traits: The traits of that layer the rule applies to,
+#            separated by semicolons.
+# 4. Other Layer: The name of the layer the rule depends on.
+# 5. Other Traits: The traits of the other layer, separated by semicolons.
+
+# Rules:
+#   - excludes: Traits never appear together with any of Other Traits.
+#   - requires: Traits only appear together with one of Other Traits.
+#   - only with: Other Traits only appear together with one of Traits.
+# Use `none` to refer to an optional layer being empty.
+
+# For example, the following rows forbid yellow eyes with a yellow mouth
+# and make sure black or red bodies only get black, face or sad hats:
+# excludes,Eyes,Yellow,Mouth,Yellow
+# requires,Body,Black;Red,Hat,Black;Face;Sad
+
+import csv
+import math
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from config import CONSTRAINTS_PATH
+from utils import CONFIG_DICT
+
+RULES = ('excludes', 'requires', 'only with')
+
+
+def read_constraints(version_path: str) -> List[List[str]]:
+    path = os.path.join(version_path, CONSTRAINTS_PATH)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', newline='') as file:
+        rows = [row for row in csv.reader(file) if any(row)]
+    if rows and rows[0][0].strip().lower() == 'rule':
+        rows = rows[1:]
+    return rows
+
+
+def get_layer_position(edition_config: CONFIG_DICT, name: str) -> int:
+    for i, layer in enumerate(edition_config):
+        if layer['name'].lower() == name.strip().lower():
+            return i
+    raise ValueError(f'Constraint refers to unknown layer `{name}`')
+
+
+def get_trait_positions(layer: Dict, traits: str) -> List[int]:
+    positions = []
+    for trait in traits.split(';'):
+        trait = trait.strip()
+        if trait.lower() == 'none':
+            trait = 'none'
+        if trait not in layer['trait_index']:
+            msg = f'Constraint refers to unknown trait `{trait}`'
+            raise ValueError(f'{msg} in layer `{layer["name"]}`')
+        positions.append(layer['trait_index'][trait])
+    return positions
+
+
+# Build the matrix of allowed trait pairs for a single constraint
+def compile_rule(edition_config: CONFIG_DICT,
+                 row: List[str]) -> Tuple[int, int, np.ndarray]:
+    if len(row) < 5:
+        raise ValueError(f'Constraint `{",".join(row)}` is incomplete')
+    rule = row[0].strip().lower()
+    if rule not in RULES:
+        raise ValueError(f'Unknown constraint rule `{row[0]}`')
+
+    a = get_layer_position(edition_config, row[1])
+    b = get_layer_position(edition_config, row[3])
+    if a == b:
+        raise ValueError('A constraint must refer to two different layers')
+    traits_a = get_trait_positions(edition_config[a], row[2])
+    traits_b = get_trait_positions(edition_config[b], row[4])
+
+    allowed = np.ones((len(edition_config[a]['traits']),
+                       len(edition_config[b]['traits'])), dtype=bool)
+    if rule == 'excludes':
+        allowed[np.ix_(traits_a, traits_b)] = False
+    elif rule == 'requires':
+        others = np.ones(allowed.shape[1], dtype=bool)
+        others[traits_b] = False
+        allowed[np.ix_(traits_a, np.flatnonzero(others))] = False
+    else:
+        others = np.ones(allowed.shape[0], dtype=bool)
+        others[traits_a] = False
+        allowed[np.ix_(np.flatnonzero(others), traits_b)] = False
+    return a, b, allowed
+
+
+# Compile all declared constraints into boolean masks.
+# Every layer gets a list of (earlier layer position, mask) pairs where
+# mask[i, j] tells if its trait i may appear with trait j of that layer
+def compile_constraints(version_path: str,
+                        edition_config: CONFIG_DICT) -> None:
+    masks = {}
+    for row in read_constraints(version_path):
+        a, b, allowed = compile_rule(edition_config, row)
+        if a < b:
+            a, b, allowed = b, a, allowed.T
+        if (a, b) in masks:
+            masks[(a, b)] &= allowed
+        else:
+            masks[(a, b)] = allowed
+
+    for layer in edition_config:
+        layer['constraints'] = []
+    for (a, b), allowed in masks.items():
+        edition_config[a]['constraints'].append((b, allowed))
+    count_constrained_groups(edition_config)
+
+
+# Check a batch of candidates (rows of trait indices) against all masks
+def apply_constraints(edition_config: CONFIG_DICT,
+                      indices: np.ndarray) -> np.ndarray:
+    valid = np.ones(len(indices), dtype=bool)
+    for a, layer in enumerate(edition_config):
+        for b, allowed in layer['constraints']:
+            valid &= allowed[indices[:, a], indices[:, b]]
+    return valid
+
+
+# Group layers that are linked to each other through constraints
+def get_constrained_groups(edition_config: CONFIG_DICT) -> List[List[int]]:
+    groups = []
+    for a, layer in enumerate(edition_config):
+        linked = {a} | {b for b, _ in layer['constraints']}
+        merged = [group for group in groups if linked & group]
+        for group in merged:
+            groups.remove(group)
+            linked |= group
+        groups.append(linked)
+    return [sorted(group) for group in groups]
+
+
+# Get the layers left linked together once a layer is summed out
+def get_elimination_scope(factors: List[Tuple[List[int], np.ndarray]],
+                          a: int) -> List[int]:
+    return sorted({b for scope, _ in factors if a in scope
+                   for b in scope} - {a})
+
+
+# Count the combinations of a group of linked layers that satisfy all their
+# constraints, by variable elimination over the pairwise masks.
+# Layers are summed out one at a time, the one leaving the smallest table
+# first, so only tables over a few layers of the group are ever built
+def count_group_combinations(edition_config: CONFIG_DICT,
+                             group: List[int]) -> int:
+    sizes = {a: len(edition_config[a]['traits']) for a in group}
+    # Counts of very large groups do not fit in 64 bits
+    dtype = np.int64 if math.prod(sizes.values()) < 2 ** 63 else object
+    # Traits with no rarity weight are never drawn, so they do not count
+    factors = [([a], (np.asarray(edition_config[a]['rarity_weights']) > 0)
+                .astype(dtype)) for a in group]
+    for a in group:
+        factors.extend(([a, b], allowed.astype(dtype))
+                       for b, allowed in edition_config[a]['constraints'])
+
+    remaining = set(group)
+    while remaining:
+        a = min(remaining, key=lambda a: (math.prod(
+            sizes[b] for b in get_elimination_scope(factors, a)), a))
+        scope = get_elimination_scope(factors, a)
+        linked = [factor for factor in factors if a in factor[0]]
+        factors = [factor for factor in factors if a not in factor[0]]
+        operands = []
+        for factor_scope, table in linked:
+            operands.extend([table, [group.index(b) for b in factor_scope]])
+        factors.append((scope, np.einsum(
+            *operands, [group.index(b) for b in scope])))
+        remaining.remove(a)
+
+    total = 1
+    for _, table in factors:
+        total *= int(table)
+    return total
+
+
+# Count the combinations of every group of linked layers once, when the
+# constraints are compiled. Each group's count is kept on its first layer
+def count_constrained_groups(edition_config: CONFIG_DICT) -> None:
+    for layer in edition_config:
+        layer['group_combinations'] = 1
+    for group in get_constrained_groups(edition_config):
+        edition_config[group[0]]['group_combinations'] = (
+            count_group_combinations(edition_config, group))
+
+
+# Get the exact number of combinations that satisfy all constraints and
+# only use traits with a rarity weight
+def count_valid_combinations(edition_config: CONFIG_DICT) -> int:
+    return math.prod(layer['group_combinations'] for layer in edition_config)
+
+
+# Enumerate the combinations of a group of linked layers that satisfy all
+# their constraints and only use traits with a rarity weight, as rows of
+# trait indices of the group's layers. Layers are added one at a time and
+# partial combinations dropped as soon as they break a constraint.
+# Returns None as soon as there would be more than limit partial combinations
+def enumerate_group_combinations(edition_config: CONFIG_DICT,
+                                 group: List[int],
+                                 limit: int) -> Optional[np.ndarray]:
+    partial = np.zeros((1, len(group)), dtype=np.intp)
+    for k, a in enumerate(group):
+        traits = np.flatnonzero(
+            np.asarray(edition_config[a]['rarity_weights']) > 0)
+        if len(partial) * len(traits) > limit:
+            return None
+        partial = np.repeat(partial, len(traits), axis=0)
+        partial[:, k] = np.tile(traits, len(partial) // max(len(traits), 1))
+        for b, allowed in edition_config[a]['constraints']:
+            partial = partial[allowed[partial[:, k],
+                                      partial[:, group.index(b)]]]
+    return partial
+
+
+# Enumerate every combination that satisfies all constraints and only uses
+# traits with a rarity weight, one group of linked layers at a time.
+# Returns None if there are more than limit of them
+def enumerate_valid_combinations(edition_config: CONFIG_DICT,
+                                 limit: int) -> Optional[np.ndarray]:
+    if count_valid_combinations(edition_config) > limit:
+        return None
+    rows = np.zeros((1, len(edition_config)), dtype=np.intp)
+    for group in get_constrained_groups(edition_config):
+        combinations = enumerate_group_combinations(edition_config, group,
+                                                    limit)
+        if combinations is None:
+            return None
+        rows = np.repeat(rows, len(combinations), axis=0)
+        rows[:, group] = np.tile(combinations, (
+            len(rows) // max(len(combinations), 1), 1))
+    return rows
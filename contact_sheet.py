@@ -0,0 +1,190 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import csv
+import os
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+from PIL import Image, ImageDraw, ImageFont
+from progressbar import ProgressBar
+
+from config import (CONTACT_SHEET_COLUMNS, CONTACT_SHEET_ROWS,
+                    CONTACT_SHEET_TILE_SIZE, CONTACT_SHEET_WORKERS,
+                    IMAGE_VARIANTS)
+from edition import get_edition_size
+from encoding import (get_edition_profile, get_edition_variants,
+                      get_image_name)
+from images import get_outputs
+from randomizer import load_groups
+from rarity import load_trait_matrix, score_edition
+from utils import (choose_edition, choose_version, create_dir,
+                   generate_paths, permission)
+
+# Contact sheets show the images of an edition as pages of labelled tiles,
+# for reviewing large editions at a glance.
+# Tiles are read from the smallest rendered size that is still as large as
+# a tile, shrunk while decoding where the format allows it, and decoded in
+# parallel a few rows ahead of the row being drawn. Only one page and a
+# bounded number of tiles are in memory at a time, whatever the edition size
+
+LABEL_HEIGHT = 14
+BACKGROUND = (32, 32, 32)
+LABEL_COLOR = (224, 224, 224)
+MISSING_COLOR = (96, 32, 32)
+
+
+# Pick the rendered images tiles are read from, the smallest ones that are
+# at least as wide as a tile. Returns their folder and encoding profile
+def get_tile_source(paths: Dict[str, str],
+                    tile_size: int) -> Tuple[str, str]:
+    outputs = get_outputs(paths, get_edition_profile(paths),
+                          get_edition_variants(paths, IMAGE_VARIANTS))
+    source = outputs[0]
+    for output in outputs[1:]:
+        if (output[0] >= tile_size
+                and os.path.exists(output[2]['images'])):
+            source = output
+    return source[2]['images'], source[1]
+
+
+# Get the rarity rank of every item, from the edition's rarity table if it
+# was created, otherwise scored on the spot
+def load_ranks(paths: Dict[str, str]) -> Dict[str, int]:
+    try:
+        with open(paths['rarity'], 'r', newline='') as file:
+            reader = csv.reader(file)
+            next(reader)
+            return {row[1]: int(row[0]) for row in reader}
+    except FileNotFoundError:
+        matrix = load_trait_matrix(paths)
+        ranks = score_edition(matrix)['rank']
+        return dict(zip(matrix.ids.tolist(), ranks.tolist()))
+
+
+# Decode an image down to tile size. JPEG images are decoded at a reduced
+# scale, other formats are reduced by a whole factor right after decoding,
+# which is much cheaper than resampling the full image
+def load_tile(path: str, tile_size: int) -> Optional[Image.Image]:
+    try:
+        with Image.open(path) as img:
+            img.draft('RGB', (tile_size, tile_size))
+            tile = img.convert('RGBA')
+    except FileNotFoundError:
+        return None
+    factor = min(tile.width, tile.height) // tile_size
+    if factor > 1:
+        tile = tile.reduce(factor)
+    tile.thumbnail((tile_size, tile_size))
+    return tile
+
+
+# Decode tiles in order, a bounded number of them ahead of the caller
+def iter_tiles(files: Iterator[str], tile_size: int, ahead: int,
+               workers: int = CONTACT_SHEET_WORKERS
+               ) -> Iterator[Optional[Image.Image]]:
+    pending: Deque[Future] = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for path in files:
+            pending.append(executor.submit(load_tile, path, tile_size))
+            if len(pending) >= ahead:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def draw_tile(page: Image.Image, draw: ImageDraw.ImageDraw,
+              font: ImageFont.ImageFont, tile: Optional[Image.Image],
+              position: Tuple[int, int], tile_size: int, label: str) -> None:
+    x, y = position
+    if tile is None:
+        draw.rectangle([x, y, x + tile_size - 1, y + tile_size - 1],
+                       fill=MISSING_COLOR)
+        draw.text((x + 4, y + 4), 'missing', fill=LABEL_COLOR, font=font)
+    else:
+        # Tiles narrower than the grid cell are centered in it
+        offset = ((tile_size - tile.width) // 2,
+                  (tile_size - tile.height) // 2)
+        page.paste(tile, (x + offset[0], y + offset[1]), tile)
+    draw.text((x + 2, y + tile_size + 1), label, fill=LABEL_COLOR, font=font)
+
+
+def get_label(idx: str, ranks: Optional[Dict[str, int]]) -> str:
+    if ranks is None:
+        return f'#{idx}'
+    return f'#{idx}  rank {ranks.get(idx, "-")}'
+
+
+# Draw the tiles of the given ids into pages saved in the output folder,
+# one row of tiles at a time. Returns the number of pages
+def create_sheets(ids: List[str], img_dir: str, profile: str,
+                  zfill_count: int, output_dir: str,
+                  ranks: Optional[Dict[str, int]] = None,
+                  tile_size: int = CONTACT_SHEET_TILE_SIZE,
+                  columns: int = CONTACT_SHEET_COLUMNS,
+                  rows: int = CONTACT_SHEET_ROWS) -> int:
+    create_dir(output_dir)
+    per_page = columns * rows
+    pages = (len(ids) + per_page - 1) // per_page
+    page_zfill = len(str(pages))
+    cell_height = tile_size + LABEL_HEIGHT
+    font = ImageFont.load_default()
+    files = (os.path.join(img_dir, get_image_name(i, zfill_count, profile))
+             for i in ids)
+    tiles = iter_tiles(files, tile_size, 2 * columns)
+
+    bar = ProgressBar(max_value=len(ids)).start()
+    for page_number in range(pages):
+        page_ids = ids[page_number * per_page:(page_number + 1) * per_page]
+        page_rows = (len(page_ids) + columns - 1) // columns
+        page = Image.new('RGB', (columns * tile_size,
+                                 page_rows * cell_height), BACKGROUND)
+        draw = ImageDraw.Draw(page)
+        for n, idx in enumerate(page_ids):
+            row, column = divmod(n, columns)
+            draw_tile(page, draw, font, next(tiles),
+                      (column * tile_size, row * cell_height), tile_size,
+                      get_label(idx, ranks))
+            bar.update(page_number * per_page + n + 1)
+        page.save(os.path.join(
+            output_dir, f'sheet {str(page_number + 1).zfill(page_zfill)}.png'))
+    tiles.close()
+    bar.finish()
+    print()
+    return pages
+
+
+def create_contact_sheets(version_path: str,
+                          edition_name: Optional[str] = None,
+                          by_group: Optional[bool] = None,
+                          show_ranks: Optional[bool] = None) -> None:
+    if edition_name is None:
+        edition_name = choose_edition(version_path)
+
+    if edition_name:
+        paths = generate_paths(version_path, edition_name)
+        edition_size = get_edition_size(paths)
+        zfill_count = len(str(edition_size))
+        img_dir, profile = get_tile_source(paths, CONTACT_SHEET_TILE_SIZE)
+
+        groups = load_groups(paths)
+        if by_group is None:
+            by_group = bool(groups) and permission('One sheet per group')
+        if show_ranks is None:
+            show_ranks = permission('Show rarity ranks')
+        ranks = load_ranks(paths) if show_ranks else None
+
+        if by_group:
+            sheets = {os.path.join(paths['sheets'], group): ids
+                      for group, ids in groups.items()}
+        else:
+            sheets = {paths['sheets']: [str(i) for i in
+                                        range(1, edition_size + 1)]}
+        print('Creating contact sheets')
+        pages = sum(create_sheets(ids, img_dir, profile, zfill_count,
+                                  output_dir, ranks)
+                    for output_dir, ids in sheets.items())
+        print(f'{pages} contact sheets saved in {paths["sheets"]}')
+
+
+if __name__ == '__main__':
+    create_contact_sheets(choose_version())
+    print('Task complete!')
@@ -0,0 +1,327 @@
+import csv
+import json
+import os
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Tuple
+
+import numpy as np
+from numpy.random import SeedSequence
+
+from utils import (atomic_write, choose_edition, choose_version, CONFIG_DICT,
+                   generate_paths, load_json_data)
+
+# An edition is stored in its folder as:
+# - layers.json: the layer and trait table, with the path of every trait,
+#                and the seed of the edition with the number of candidates
+#                drawn so far, so extending an edition continues its streams
+# - traits.npy: matrix of trait indices, one row per item and one column per
+#               layer, memory-mapped when read
+# - ranks.npy: sorted combination ranks of every item, the uniqueness index
+# assets.csv and assets.json are exports created from them on demand
+
+EXPORT_FORMATS = ('csv', 'json')
+
+# Random streams derived from an edition's seed.
+# Every stream is identified by a spawn key, so any of them can be
+# recreated on its own, in any process and in any order
+CANDIDATE_STREAM = 0
+RANKED_STREAM = 1
+GROUP_STREAM = 2
+
+
+def get_generator(seed: int, *key: int) -> np.random.Generator:
+    return np.random.default_rng(SeedSequence(seed, spawn_key=key))
+
+
+class EditionSeed:
+    def __init__(self, seed: Optional[int] = None, position: int = 0) -> None:
+        self.seed = SeedSequence().entropy if seed is None else seed
+        # Number of candidates drawn from the candidate streams
+        self.position = position
+
+    def generator(self, *key: int) -> np.random.Generator:
+        return get_generator(self.seed, *key)
+
+
+def get_trait_names(edition_config: CONFIG_DICT) -> List[List[str]]:
+    return [[trait if trait is not None else 'none'
+             for trait in layer['traits']] for layer in edition_config]
+
+
+# Write through a temporary file so a crash never corrupts the edition
+def save_array(path: str, array: np.ndarray) -> None:
+    with atomic_write(path, 'wb') as file:
+        np.save(file, array)
+
+
+def save_layer_table(path: str, table: Dict[str, Any]) -> None:
+    with atomic_write(path) as file:
+        json.dump(table, file)
+
+
+def get_trait_dtype(traits: np.ndarray) -> type:
+    return np.uint8 if traits.size == 0 or traits.max() < 256 else np.uint16
+
+
+def save_edition_state(paths: Dict[str, str], edition_config: CONFIG_DICT,
+                       traits: np.ndarray, ranks: Optional[np.ndarray],
+                       seed: EditionSeed) -> None:
+    table = {'layers': [layer['name'] for layer in edition_config],
+             'traits': get_trait_names(edition_config),
+             'paths': [layer['paths'] for layer in edition_config],
+             'seed': seed.seed, 'position': seed.position}
+    if ranks is None:
+        ranks = np.empty(0, dtype=np.int64)
+    save_array(paths['traits'], traits.astype(get_trait_dtype(traits)))
+    save_array(paths['ranks'], ranks)
+    # The table is written last, once the arrays it describes are complete
+    save_layer_table(paths['layers'], table)
+
+
+# Build the layer and trait table of an edition from its csv and json.
+# Traits are taken from the items themselves, so the assets do not need to
+# be parsed again. The layer paths in the json skip `none` traits
+def migrate_exports(paths: Dict[str, str]
+                    ) -> Tuple[Dict[str, Any], np.ndarray]:
+    with open(paths['csv'], 'r', newline='') as file:
+        reader = csv.reader(file)
+        layers = next(reader)[1:]
+        rows = [row[1:] for row in reader]
+    all_paths = list(load_json_data(paths['json']).values())
+
+    trait_paths: List[Dict[str, Optional[str]]] = [{} for _ in layers]
+    for names, layer_paths in zip(rows, all_paths):
+        layer_paths = iter(layer_paths)
+        for j, name in enumerate(names):
+            trait_paths[j][name] = (None if name == 'none'
+                                    else next(layer_paths))
+    traits = [sorted(trait_paths[j], key=lambda name: (name != 'none', name))
+              for j in range(len(layers))]
+    index = [{name: i for i, name in enumerate(names)} for names in traits]
+    matrix = np.array([[index[j][name] for j, name in enumerate(names)]
+                       for names in rows], dtype=np.intp)
+    table = {'layers': layers, 'traits': traits,
+             'paths': [[trait_paths[j][name] for name in names]
+                       for j, names in enumerate(traits)]}
+    return table, matrix.reshape(-1, len(layers))
+
+
+# Editions created before the compact format have their items in assets.csv
+# and assets.json, and possibly their seed in state.npz.
+# Convert them once, the csv and json are kept as exports and updated
+# whenever the edition changes
+def migrate_edition(paths: Dict[str, str]) -> bool:
+    if not os.path.exists(paths['json']):
+        return False
+    table, traits = migrate_exports(paths)
+    table['seed'], table['position'] = None, 0
+    try:
+        with np.load(paths['state']) as state:
+            meta = json.loads(str(state['meta']))
+        table['seed'] = meta.get('seed')
+        table['position'] = meta.get('position', 0)
+    except FileNotFoundError:
+        pass
+    if table['seed'] is None:
+        table['seed'] = SeedSequence().entropy
+    save_array(paths['traits'], traits.astype(get_trait_dtype(traits)))
+    save_array(paths['ranks'], np.empty(0, dtype=np.int64))
+    save_layer_table(paths['layers'], table)
+    if os.path.exists(paths['state']):
+        os.remove(paths['state'])
+    return True
+
+
+def edition_exists(paths: Dict[str, str]) -> bool:
+    return os.path.exists(paths['layers']) or os.path.exists(paths['json'])
+
+
+# Get the layer and trait table of an edition, None if it has no items
+def load_layer_table(paths: Dict[str, str]) -> Optional[Dict[str, Any]]:
+    if not os.path.exists(paths['layers']) and not migrate_edition(paths):
+        return None
+    with open(paths['layers'], 'r') as file:
+        return json.load(file)
+
+
+# Map trait indices saved with an older configuration to the current one.
+# Traits added to the assets since then shift indices around
+def remap_traits(edition_config: CONFIG_DICT, table: Dict[str, Any],
+                 traits: np.ndarray) -> np.ndarray:
+    # Layer names of migrated editions come from the csv header
+    if ([name.lower() for name in table['layers']]
+            != [layer['name'].lower() for layer in edition_config]):
+        raise ValueError('The layers of this version changed since the'
+                         ' edition was created')
+    remapped = np.empty(traits.shape, dtype=np.intp)
+    for j, (layer, names) in enumerate(zip(edition_config, table['traits'])):
+        try:
+            mapping = np.array([layer['trait_index'][name] for name in names],
+                               dtype=np.intp)
+        except KeyError as e:
+            raise ValueError(f'Trait {e} of layer `{layer["name"]}` no longer'
+                             ' exists') from None
+        remapped[:, j] = mapping[traits[:, j]]
+    return remapped
+
+
+# Load the saved state of an edition.
+# Returns the trait matrix, the sorted ranks (None if they need to be
+# computed again) and the edition seed, or None if nothing was saved
+def load_edition_state(paths: Dict[str, str], edition_config: CONFIG_DICT
+                       ) -> Optional[Tuple[np.ndarray, Optional[np.ndarray],
+                                           EditionSeed]]:
+    table = load_layer_table(paths)
+    if table is None:
+        return None
+    traits = np.load(paths['traits']).astype(np.intp)
+    ranks = np.load(paths['ranks'])
+
+    seed = EditionSeed(table['seed'], table['position'])
+    if (table['layers'] != [layer['name'] for layer in edition_config]
+            or table['traits'] != get_trait_names(edition_config)):
+        return remap_traits(edition_config, table, traits), None, seed
+    return traits, ranks if len(ranks) == len(traits) else None, seed
+
+
+# Load only the seed of an edition, None if it has no saved state
+def load_edition_seed(paths: Dict[str, str]) -> Optional[EditionSeed]:
+    table = load_layer_table(paths)
+    if table is None:
+        return None
+    return EditionSeed(table['seed'], table['position'])
+
+
+# Read-only view of an edition's items, mapping every id to its layer paths.
+# Items are looked up in the memory-mapped trait matrix when accessed,
+# so opening an edition only reads its layer and trait table
+class EditionData(Mapping[str, List[str]]):
+    def __init__(self, paths: Dict[str, str]) -> None:
+        table = load_layer_table(paths)
+        if table is None:
+            raise FileNotFoundError(f'No edition in {paths["edition"]}')
+        self.layers: List[str] = table['layers']
+        self.traits: List[List[str]] = table['traits']
+        self.paths: List[List[Optional[str]]] = table['paths']
+        self.matrix = np.load(paths['traits'], mmap_mode='r')
+
+    def __len__(self) -> int:
+        return len(self.matrix)
+
+    def __iter__(self) -> Iterator[str]:
+        return (str(i) for i in range(1, len(self.matrix) + 1))
+
+    def __contains__(self, idx: object) -> bool:
+        return (isinstance(idx, str) and idx.isdigit()
+                and 0 < int(idx) <= len(self.matrix))
+
+    def get_row(self, idx: str) -> List[int]:
+        if idx not in self:
+            raise KeyError(idx)
+        return self.matrix[int(idx) - 1].tolist()
+
+    def __getitem__(self, idx: str) -> List[str]:
+        return [self.paths[j][t] for j, t in enumerate(self.get_row(idx))
+                if self.paths[j][t] is not None]
+
+    # Get the trait names of an item, `none` for empty layers
+    def get_names(self, idx: str) -> List[str]:
+        return [self.traits[j][t] for j, t in enumerate(self.get_row(idx))]
+
+
+def load_edition_data(paths: Dict[str, str]) -> EditionData:
+    return EditionData(paths)
+
+
+def get_edition_size(paths: Dict[str, str]) -> int:
+    if load_layer_table(paths) is None:
+        return 0
+    return len(np.load(paths['traits'], mmap_mode='r'))
+
+
+# Write the items of an edition in the csv and json formats,
+# one item at a time
+def export_csv(edition: EditionData, path: str) -> None:
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow([''] + [layer.title() for layer in edition.layers])
+        for idx in edition:
+            writer.writerow([idx] + edition.get_names(idx))
+
+
+def export_json(edition: EditionData, path: str) -> None:
+    with open(path, 'w') as file:
+        file.write('{')
+        for idx in edition:
+            if idx != '1':
+                file.write(', ')
+            file.write(f'{json.dumps(idx)}: {json.dumps(edition[idx])}')
+        file.write('}')
+
+
+def export_edition(paths: Dict[str, str],
+                   formats: Tuple[str, ...] = EXPORT_FORMATS) -> None:
+    edition = load_edition_data(paths)
+    for fmt in formats:
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f'Unknown export format `{fmt}`')
+        print(f'Exporting assets.{fmt}')
+        (export_csv if fmt == 'csv' else export_json)(edition, paths[fmt])
+
+
+# Add the items after the first `start` ones to an existing export.
+# New json items are written over its closing brace
+def append_csv(edition: EditionData, path: str, start: int) -> None:
+    with open(path, 'a', newline='') as file:
+        writer = csv.writer(file)
+        for i in range(start + 1, len(edition) + 1):
+            writer.writerow([str(i)] + edition.get_names(str(i)))
+
+
+def append_json(edition: EditionData, path: str, start: int) -> None:
+    with open(path, 'rb+') as file:
+        file.seek(-1, os.SEEK_END)
+        if file.read(1) != b'}':
+            raise ValueError(f'{path} is not a valid assets json')
+        file.seek(-1, os.SEEK_END)
+        for i in range(start + 1, len(edition) + 1):
+            idx = str(i)
+            item = f'{json.dumps(idx)}: {json.dumps(edition[idx])}'
+            file.write((item if i == 1 else ', ' + item).encode())
+        file.write(b'}')
+
+
+# Export an edition to the given formats, and keep the formats it was
+# already exported to up to date. Exports holding the first `start` items
+# only get the items after them, others are written in full
+def update_exports(paths: Dict[str, str], formats: Tuple[str, ...] = (),
+                   start: int = 0) -> None:
+    for fmt in formats:
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f'Unknown export format `{fmt}`')
+    existing = tuple(fmt for fmt in EXPORT_FORMATS
+                     if os.path.exists(paths[fmt]))
+    new = tuple(fmt for fmt in EXPORT_FORMATS
+                if fmt in formats and (fmt not in existing or not start))
+    if new:
+        export_edition(paths, new)
+    appended = tuple(fmt for fmt in existing if fmt not in new)
+    if appended:
+        edition = load_edition_data(paths)
+        for fmt in appended:
+            print(f'Adding new items to assets.{fmt}')
+            (append_csv if fmt == 'csv' else append_json)(
+                edition, paths[fmt], start)
+
+
+def export_assets(version_path: str,
+                  edition_name: Optional[str] = None) -> None:
+    if edition_name is None:
+        edition_name = choose_edition(version_path)
+
+    if edition_name:
+        export_edition(generate_paths(version_path, edition_name))
+
+
+if __name__ == '__main__':
+    export_assets(choose_version())
+    print('Task complete!')
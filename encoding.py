@@ -0,0 +1,207 @@
+import hashlib
+from io import BytesIO
+import json
+import os
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from PIL import Image
+from progressbar import progressbar
+
+from config import ENCODING_PROFILE
+import instrument
+from journal import JournalEntry, read_journal, rewrite_journal
+from utils import (atomic_write, choose_edition, choose_version,
+                   generate_paths, get_variant_paths)
+
+# Ways of encoding rendered images.
+# format and options are passed on to Image.save.
+# colors quantizes images to a palette of that many colors before saving.
+# raw is an uncompressed working format, meant to be re-encoded later
+PROFILES: Dict[str, Dict[str, Any]] = {
+    'png': {'format': 'PNG', 'extension': '.png', 'options': {}},
+    'png-fast': {'format': 'PNG', 'extension': '.png',
+                 'options': {'compress_level': 1}},
+    'png-palette': {'format': 'PNG', 'extension': '.png', 'options': {},
+                    'colors': 256},
+    'webp-lossless': {'format': 'WEBP', 'extension': '.webp',
+                      'options': {'lossless': True, 'exact': True,
+                                  'quality': 0, 'method': 0}},
+    'raw': {'format': 'TIFF', 'extension': '.tiff',
+            'options': {'compression': 'raw'}},
+}
+
+
+def get_profile(name: str) -> Dict[str, Any]:
+    try:
+        return PROFILES[name]
+    except KeyError:
+        raise ValueError(f'Unknown encoding profile `{name}`') from None
+
+
+def get_image_name(index: str, zfill_count: int,
+                   profile: str = ENCODING_PROFILE) -> str:
+    return index.zfill(zfill_count) + get_profile(profile)['extension']
+
+
+# Save an image through a temporary file that is renamed once complete,
+# so an interrupted write never leaves a truncated image behind.
+# The image is not synced, callers sync a whole batch with sync_files
+# before journaling it. Returns the size and sha256 of the written file
+def save_image(img: Image.Image, path: str,
+               profile: str = ENCODING_PROFILE) -> Tuple[int, str]:
+    settings = get_profile(profile)
+    # Encode in memory so the checksum does not require reading the file back
+    with instrument.timer('render.encode'):
+        if 'colors' in settings:
+            img = img.quantize(settings['colors'],
+                               method=Image.Quantize.FASTOCTREE)
+        buffer = BytesIO()
+        img.save(buffer, settings['format'], **settings['options'])
+        data = buffer.getbuffer()
+    with instrument.timer('render.write'):
+        with atomic_write(path, 'wb') as file:
+            file.write(data)
+    instrument.count('render.bytes', len(data))
+    return len(data), hashlib.sha256(data).hexdigest()
+
+
+# The encoding of an edition is recorded in its folder as
+# {'profile': profile, 'variants': [[width, profile or None], ...]}
+def load_encoding(paths: Dict[str, str]) -> Optional[Dict[str, Any]]:
+    try:
+        with open(paths['encoding'], 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def write_encoding(paths: Dict[str, str], profile: str,
+                   variants: List[Tuple[int, Optional[str]]]) -> None:
+    with atomic_write(paths['encoding']) as file:
+        json.dump({'profile': profile,
+                   'variants': [list(variant) for variant in variants]}, file)
+
+
+def read_variants(encoding: Dict[str, Any]) -> List[Tuple[int, Optional[str]]]:
+    return [(width, profile)
+            for width, profile in encoding.get('variants', [])]
+
+
+# Get the encoding profile of an edition, or the configured one if the
+# edition's images were never rendered
+def get_edition_profile(paths: Dict[str, str],
+                        profile: Optional[str] = None) -> str:
+    encoding = load_encoding(paths)
+    if encoding is not None:
+        return encoding['profile']
+    profile = profile or ENCODING_PROFILE
+    get_profile(profile)
+    return profile
+
+
+# Get the smaller sizes of an edition's images.
+# The given sizes are added to the recorded ones, and sizes that were
+# already recorded keep their profile
+def get_edition_variants(paths: Dict[str, str],
+                         variants: Sequence[Tuple[int, Optional[str]]] = ()
+                         ) -> List[Tuple[int, Optional[str]]]:
+    encoding = load_encoding(paths)
+    recorded = read_variants(encoding) if encoding is not None else []
+    widths = {width for width, _ in recorded}
+    added = []
+    for width, variant_profile in variants:
+        if width not in widths:
+            widths.add(width)
+            added.append((width, variant_profile))
+    return recorded + added
+
+
+# Record the encoding of an edition before its images are rendered, so
+# later runs keep using the same profile and sizes even if the
+# configuration changes. Returns the profile and sizes to render
+def record_encoding(paths: Dict[str, str], profile: Optional[str] = None,
+                    variants: Sequence[Tuple[int, Optional[str]]] = ()
+                    ) -> Tuple[str, List[Tuple[int, Optional[str]]]]:
+    encoding = load_encoding(paths)
+    profile = get_edition_profile(paths, profile)
+    variants = get_edition_variants(paths, variants)
+    if encoding is None or read_variants(encoding) != variants:
+        write_encoding(paths, profile, variants)
+    return profile, variants
+
+
+# Make written files durable. The journal vouches for images, so they must
+# reach the disk before they are journaled. A single sync covers the whole
+# batch, platforms without one sync every file on its own
+def sync_files(paths: Iterable[str]) -> None:
+    with instrument.timer('render.sync'):
+        if hasattr(os, 'sync'):
+            os.sync()
+            return
+        for path in paths:
+            with open(path, 'rb+') as file:
+                os.fsync(file.fileno())
+
+
+# Re-encode every image of a directory, for instance from the raw working
+# format to the final one. Returns the journal entries of the new files
+def reencode_dir(img_dir: str, source: str,
+                 target: str) -> Dict[str, JournalEntry]:
+    source_ext = get_profile(source)['extension']
+    target_ext = get_profile(target)['extension']
+    entries = {}
+    for name in progressbar(sorted(os.listdir(img_dir))):
+        path = os.path.join(img_dir, name)
+        if name.endswith(source_ext) and os.path.isfile(path):
+            new_name = name[:-len(source_ext)] + target_ext
+            with Image.open(path) as img:
+                img.load()
+                entries[name] = JournalEntry(new_name, *save_image(
+                    img, os.path.join(img_dir, new_name), target))
+    # Originals are only removed once their new files are on the disk
+    sync_files(os.path.join(img_dir, entry.name)
+               for entry in entries.values())
+    if source_ext != target_ext:
+        for name in entries:
+            os.remove(os.path.join(img_dir, name))
+    return entries
+
+
+def reencode_images(version_path: str, target: str,
+                    edition_name: Optional[str] = None) -> None:
+    if edition_name is None:
+        edition_name = choose_edition(version_path)
+
+    if edition_name:
+        paths = generate_paths(version_path, edition_name)
+        source = get_edition_profile(paths)
+        get_profile(target)
+        variants = get_edition_variants(paths)
+        print(f'Re-encoding images from `{source}` to `{target}`')
+        # Sizes with a profile of their own keep it
+        for output_paths in [paths] + [get_variant_paths(paths, width)
+                                       for width, profile in variants
+                                       if profile is None]:
+            for root, _, _ in os.walk(output_paths['images']):
+                entries = reencode_dir(root, source, target)
+                if (root == output_paths['images']
+                        and os.path.exists(output_paths['journal'])):
+                    # Journal the re-encoded images under their new names
+                    journal = read_journal(output_paths['journal'])
+                    rewrite_journal(output_paths['journal'], {
+                        i: entries.get(entry.name, entry)
+                        for i, entry in journal.items()})
+        write_encoding(paths, target, variants)
+        print()
+
+
+if __name__ == '__main__':
+    print('Choose the target encoding profile:')
+    profiles = dict(enumerate(PROFILES, start=1))
+    for i, name in profiles.items():
+        print(i, name)
+    response = ''
+    while response not in map(str, profiles):
+        response = input()
+    reencode_images(choose_version(), profiles[int(response)])
+    print('Task complete!')
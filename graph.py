@@ -1,41 +1,150 @@
+import argparse
 import os
-from typing import Optional
+from typing import Dict, Optional, Tuple
 
+from matplotlib.figure import Figure
 import matplotlib.pyplot as plt
+import numpy as np
+
+from config import GRAPH_BINS, GRAPH_MAX_POINTS
+from rarity import load_trait_matrix, score_edition
+from utils import choose_edition, choose_version, create_dir, generate_paths
+
+
+# Load rarity scores without going through Python lists.
+# An up to date binary copy is memory-mapped,
+# otherwise the text file is parsed in one go.
+# Editions that were not scored yet are scored on the spot
+def load_scores(paths: Dict[str, str]) -> np.ndarray:
+    if not os.path.exists(paths['score']):
+        return score_edition(load_trait_matrix(paths))['rarity_score']
+    if (os.path.exists(paths['score_array'])
+        and os.path.getmtime(paths['score_array'])
+            >= os.path.getmtime(paths['score'])):
+        return np.load(paths['score_array'], mmap_mode='r')
+    return np.fromfile(paths['score'], sep=' ')
+
+
+# Keep at most max_points evenly spread points of a sorted curve
+def downsample(y: np.ndarray, max_points: int) -> Tuple[np.ndarray,
+                                                          np.ndarray]:
+    if len(y) <= max_points:
+        x = np.arange(len(y))
+    else:
+        x = np.unique(np.linspace(0, len(y) - 1, max_points).astype(int))
+    return x, y[x]
+
+
+def plot_curve(fig: Figure, y: np.ndarray, max_points: int) -> None:
+    ax = fig.add_subplot()
+    # plotting the points
+    ax.plot(*downsample(y, max_points))
+    # naming the axes
+    ax.set_xlabel('Asset #')
+    ax.set_ylabel('Rarity Score')
+    # giving a title to the graph
+    ax.set_title('Rarity Score')
+
+
+def plot_histogram(fig: Figure, y: np.ndarray, bins: int) -> None:
+    ax = fig.add_subplot()
+    counts, edges = np.histogram(y, bins=bins)
+    ax.stairs(counts, edges, fill=True)
+    ax.set_xlabel('Rarity Score')
+    ax.set_ylabel('Assets')
+    ax.set_title('Rarity Score Distribution')
+
+
+def plot_layer(fig: Figure, name: str, traits: np.ndarray,
+               codes: np.ndarray) -> None:
+    ax = fig.add_subplot()
+    counts = np.bincount(codes, minlength=len(traits))
+    order = np.argsort(-counts)
+    ax.bar(np.arange(len(traits)), counts[order])
+    ax.set_xticks(np.arange(len(traits)), traits[order], rotation=90)
+    ax.set_ylabel('Assets')
+    ax.set_title(f'{name} Distribution')
+    fig.tight_layout()
+
+
+def save_figure(fig: Figure, path: str) -> None:
+    fig.savefig(path)
+    print(f'Saved {os.path.basename(path)}')
+
+
+# Write all QA charts of an edition without needing a display
+def save_graphs(paths: Dict[str, str], y: np.ndarray, fmt: str,
+                max_points: int, bins: int) -> None:
+    create_dir(paths['graphs'])
+
+    fig = Figure()
+    plot_curve(fig, y, max_points)
+    save_figure(fig, os.path.join(paths['graphs'], f'rarity score.{fmt}'))
+
+    fig = Figure()
+    plot_histogram(fig, y, bins)
+    save_figure(fig, os.path.join(paths['graphs'],
+                                  f'rarity distribution.{fmt}'))
+
+    matrix = load_trait_matrix(paths)
+    for j, name in enumerate(matrix.layers):
+        fig = Figure(figsize=(max(6.4, len(matrix.traits[j]) * 0.3), 4.8))
+        plot_layer(fig, name, matrix.traits[j], matrix.codes[:, j])
+        save_figure(fig, os.path.join(paths['graphs'],
+                                      f'layer {name.lower()}.{fmt}'))
 
-from utils import choose_edition, choose_version, generate_paths
 
 def draw_graph(version_path: Optional[str] = None,
-               edition_name: Optional[str] = None) -> None:
+               edition_name: Optional[str] = None,
+               headless: bool = False, fmt: str = 'png',
+               max_points: int = GRAPH_MAX_POINTS,
+               bins: int = GRAPH_BINS) -> None:
     if version_path is None:
         version_path = choose_version()
-    
+
     if version_path:
         if edition_name is None:
             edition_name = choose_edition(version_path)
 
         if edition_name:
             paths = generate_paths(version_path, edition_name)
-            path = os.path.join(paths['edition'], 'score.txt')
-
-            with open(path, 'r') as file:
-                y = sorted(float(line.rstrip()) for line in file.readlines())
+            y = np.sort(load_scores(paths))
 
-            x = range(len(y))
-            # plotting the points
-            plt.plot(x, y)
+            if headless:
+                save_graphs(paths, y, fmt, max_points, bins)
+            else:
+                plot_curve(plt.figure(), y, max_points)
+                plot_histogram(plt.figure(), y, bins)
 
-            # naming the x axis
-            plt.xlabel('Asset #')
-            # naming the y axis
-            plt.ylabel('Rarity Score')
+                # function to show the plot
+                plt.show()
 
-            # giving a title to my graph
-            plt.title('Rarity Score')
 
-            # function to show the plot
-            plt.show()
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Plot the rarity scores and trait distributions of an'
+                    ' edition. Without arguments, asks for the version and'
+                    ' edition and shows the graphs')
+    parser.add_argument('version', nargs='?',
+                        help='path of the version folder')
+    parser.add_argument('edition', nargs='?', help='name of the edition')
+    parser.add_argument('--headless', action='store_true',
+                        help='save the graphs in the edition folder instead'
+                             ' of showing them')
+    parser.add_argument('-f', '--format', default='png',
+                        help='file format of saved graphs (default: png)')
+    parser.add_argument('--max-points', type=int, default=GRAPH_MAX_POINTS,
+                        help='most points plotted on the rarity curve')
+    parser.add_argument('--bins', type=int, default=GRAPH_BINS,
+                        help='number of bins of the rarity histogram')
+    args = parser.parse_args()
+    # Only ask for the edition when nothing is given on the command line
+    if (args.version or args.headless) and not args.edition:
+        parser.error('the version and edition are required')
+    return args
 
 
 if __name__ == '__main__':
-    draw_graph()
\ No newline at end of file
+    args = parse_args()
+    draw_graph(args.version, args.edition, args.headless, args.format,
+               args.max_points, args.bins)
@@ -1,36 +1,62 @@
+from concurrent.futures import as_completed, ProcessPoolExecutor
 import os
 import time
-from typing import Dict, List, Optional
+from typing import (Any, Dict, Iterable, List, Mapping, Optional, Sequence,
+                    Set, Tuple)
 
 from PIL import Image
-from progressbar import progressbar
+from progressbar import ProgressBar
 
-from randomizer import randomize_check, randomized
+from compositor import composite_layers, get_backend
+from config import (ENCODING_PROFILE, IMAGE_VARIANTS, LAYER_CACHE_SIZE,
+                    MATERIALIZE_GROUPS, RENDER_CHUNK_SIZE, RENDER_WORKERS)
+from edition import load_edition_data
+from encoding import (get_edition_profile, get_edition_variants,
+                      get_image_name, get_profile, record_encoding,
+                      save_image, sync_files)
+import instrument
+from journal import (append_journal, get_finished_ids, JournalEntry,
+                     load_journal, verify_journal)
+from randomizer import load_groups, materialize_groups, randomized
 from utils import (choose_dir, choose_edition, choose_version, create_dir,
-                   generate_paths, load_json_data, permission)
+                   generate_paths, get_variant_paths, permission)
 
+# Images can be saved at several sizes at once, each in its own folder of the
+# edition with its own render journal.
+# An output is the width of its images (None for full size), their encoding
+# profile and the paths of its images folder and journal
+Output = Tuple[Optional[int], str, Dict[str, str]]
+# Id and layer paths of an image, with the width, profile and path of every
+# output it is missing
+Job = Tuple[str, List[str], List[Tuple[Optional[int], str, str]]]
 
-# Generate a single image given an array of filepaths representing layers
-def generate_single_image(filepaths, output_filename=None):
-    # Treat the first layer as the background
-    bg = Image.open(os.path.join('assets', filepaths[0]))
 
-    # Loop through layers 1 to n and stack them on top of another
-    for filepath in filepaths[1:]:
-        if filepath.endswith('.png'):
-            img = Image.open(os.path.join('assets', filepath))
-            bg.paste(img, (0,0), img)
+def print_cache_stats(stats: Dict[str, int]) -> None:
+    total = stats['hits'] + stats['misses']
+    if total:
+        print(f'Layer cache: {stats["hits"]} hits, {stats["misses"]} misses'
+              f' ({stats["hits"] / total:.1%} hit rate),'
+              f' {stats["evictions"]} evictions')
+
+
+# Generate a single image given an array of filepaths representing layers.
+# Returns the size and sha256 of the saved file
+def generate_single_image(filepaths, output_filename=None, prefixes=None,
+                          profile=ENCODING_PROFILE):
+    with instrument.timer('render.composite'):
+        bg = composite_layers(filepaths, prefixes)
+    instrument.count('render.images')
 
     # Save the final image into desired location
-    if output_filename is not None:
-        bg.save(output_filename)
-    else:
+    if output_filename is None:
         # If output filename is not specified,
         # use timestamp to name the image and save it in output/single_images
         if not os.path.exists(os.path.join('output', 'single_images')):
             os.makedirs(os.path.join('output', 'single_images'))
-        bg.save(os.path.join('output', 'single_images',
-                             str(int(time.time())) + '.png'))
+        output_filename = os.path.join(
+            'output', 'single_images',
+            get_image_name(str(int(time.time())), 0, profile))
+    return save_image(bg, output_filename, profile)
 
 
 def get_edition_name_to_print(img_dir: str) -> str:
@@ -41,68 +67,294 @@ def get_edition_name_to_print(img_dir: str) -> str:
     return f'{get_edition_name_to_print(dirname)}: {basename}'
 
 
-def generate_images(json_path: str, img_dir: str,
-                    zfill_count: int) -> None:
-    
-    all_data = load_json_data(json_path)
-    if all_data:
-        create_dir(img_dir)
-        edition_name = get_edition_name_to_print(img_dir)
-        print(f'Generating `{edition_name}` images')
-        # Will require this to name final images as 000, 001,...
-        for i, data in progressbar(all_data.items()):
-            # Set image name
-            image_name = i.zfill(zfill_count) + '.png'
+def get_image_names(ids: List[str], zfill_count: int,
+                    profile: str = ENCODING_PROFILE) -> Dict[str, str]:
+    # Will require this to name final images as 000, 001,...
+    return {i: get_image_name(i, zfill_count, profile) for i in ids}
+
+
+# Parse output sizes given as `width[:profile]`, separated by commas.
+# Sizes without a profile use the edition's
+def parse_variants(text: str) -> List[Tuple[int, Optional[str]]]:
+    variants = []
+    for variant in filter(None, map(str.strip, text.split(','))):
+        width, _, profile = variant.partition(':')
+        if not width.isdigit() or not int(width):
+            raise ValueError(f'Invalid output width `{width}`')
+        if profile:
+            get_profile(profile)
+        variants.append((int(width), profile or None))
+    return variants
+
+
+# Get every output of an edition's images, the full size images first and
+# then every smaller size from the largest down, each with its encoding
+# profile and the paths of its images folder and render journal
+def get_outputs(paths: Dict[str, str], profile: str = ENCODING_PROFILE,
+                variants: Sequence[Tuple[int, Optional[str]]] = (
+                    IMAGE_VARIANTS)) -> List[Output]:
+    outputs = [(None, profile, paths)]
+    for width, variant_profile in sorted(set(variants), reverse=True,
+                                         key=lambda variant: variant[0]):
+        if outputs[-1][0] == width:
+            raise ValueError(f'Output width {width} is given twice')
+        outputs.append((width, variant_profile or profile,
+                        get_variant_paths(paths, width)))
+    return outputs
+
+
+# Get the width, profile and path of an image in every output
+def get_output_files(idx: str, zfill_count: int, outputs: List[Output]
+                     ) -> List[Tuple[Optional[int], str, str]]:
+    return [(width, profile, os.path.join(
+                output_paths['images'],
+                get_image_name(idx, zfill_count, profile)))
+            for width, profile, output_paths in outputs]
+
+
+# Get the ids every output already has, in the order of the outputs.
+# Finished images come from the render journals, the images folders are only
+# read to create missing journals. Images of old group folders are moved
+# back first so they are found
+def get_finished_images(paths: Dict[str, str], ids: List[str],
+                        zfill_count: int,
+                        outputs: List[Output]) -> List[Set[str]]:
+    load_groups(paths)
+    finished = []
+    for _, output_profile, output_paths in outputs:
+        create_dir(output_paths['images'])
+        names = get_image_names(ids, zfill_count, output_profile)
+        finished.append(set(get_finished_ids(load_journal(output_paths, names),
+                                             names)))
+    return finished
+
+
+# Get the jobs of the given images that some outputs are still missing
+def get_missing_jobs(all_data: Mapping[str, List[str]], ids: Iterable[str],
+                     zfill_count: int, outputs: List[Output],
+                     finished: List[Set[str]]) -> List[Job]:
+    jobs = []
+    for i in ids:
+        files = [file for file, done in zip(
+                     get_output_files(i, zfill_count, outputs), finished)
+                 if i not in done]
+        if files:
+            jobs.append((i, all_data[i], files))
+    return jobs
+
+
+# Get the images that still need to be generated, with the outputs each of
+# them is missing.
+# If ids are given, only those images are considered
+def get_render_jobs(all_data: Mapping[str, List[str]],
+                    paths: Dict[str, str], zfill_count: int,
+                    profile: str = ENCODING_PROFILE,
+                    ids: Optional[List[str]] = None,
+                    variants: Sequence[Tuple[int, Optional[str]]] = (
+                        IMAGE_VARIANTS)) -> List[Job]:
+    if not all_data:
+        return []
+    ids = list(all_data if ids is None else ids)
+    outputs = get_outputs(paths, profile, variants)
+    return get_missing_jobs(all_data, ids, zfill_count, outputs,
+                            get_finished_images(paths, ids, zfill_count,
+                                                outputs))
+
+
+# Composite an image once and save it at every size it is missing.
+# Smaller sizes come from a resize pyramid, each size is resized from the
+# next larger one. `widths` holds every size of the edition from the
+# largest down, so an image is resized the same way whichever are missing.
+# Returns the journal entries of the saved images, by width
+def render_outputs(filepaths: List[str],
+                   files: List[Tuple[Optional[int], str, str]],
+                   widths: List[int], prefixes=None
+                   ) -> Dict[Optional[int], JournalEntry]:
+    with instrument.timer('render.composite'):
+        img = composite_layers(filepaths, prefixes)
+    instrument.count('render.images')
+
+    targets = {width: (profile, path) for width, profile, path in files}
+    smallest = min((width for width in targets if width is not None),
+                   default=None)
+    entries = {}
+    for width in [None] + [width for width in widths
+                           if smallest is not None and width >= smallest]:
+        if width is not None:
+            with instrument.timer('render.resize'):
+                img = img.resize(
+                    (width, max(round(img.height * width / img.width), 1)),
+                    Image.Resampling.LANCZOS)
+        if width in targets:
+            profile, path = targets[width]
+            entries[width] = JournalEntry(os.path.basename(path),
+                                          *save_image(img, path, profile))
+    return entries
 
-            img_path = os.path.join(img_dir, image_name)
-            if not os.path.exists(img_path):
-                # Generate the actual image
-                generate_single_image(data, img_path)
-        print()
 
+# Generate a chunk of images and report how the layer cache was used.
+# Runs inside worker processes, each of which has its own layer cache.
+# Returns the journal entries of every output along with the cache stats,
+# and what the worker recorded if instrumentation is on
+def render_chunk(jobs: List[Job], widths: List[int]
+                 ) -> Tuple[Dict[Optional[int], Dict[str, JournalEntry]],
+                            Dict[str, Any]]:
+    cache = get_backend().cache
+    before = cache.stats()
+    prefixes = []
+    entries: Dict[Optional[int], Dict[str, JournalEntry]] = {}
+    for i, data, files in jobs:
+        # Generate the actual image
+        for width, entry in render_outputs(data, files, widths,
+                                           prefixes).items():
+            entries.setdefault(width, {})[i] = entry
+    # The chunk is synced once, before the parent journals it
+    sync_files(path for _, _, files in jobs for _, _, path in files)
+    after = cache.stats()
+    stats = {key: after[key] - before[key]
+             for key in ('hits', 'misses', 'evictions')}
+    stats['images'] = len(jobs)
+    stats['instruments'] = instrument.collect()
+    return entries, stats
 
-def images_main(version_path: str, edition_name: Optional[str] = None) -> None:
+
+# Start a render process. Every process has its own layer cache,
+# so each one gets an equal share of the cache budget
+def init_render_worker(instruments: bool, workers: int) -> None:
+    instrument.init_worker(instruments)
+    get_backend().cache.max_size = LAYER_CACHE_SIZE // workers
+
+
+def get_render_pool(workers: Optional[int]) -> ProcessPoolExecutor:
+    workers = workers or os.cpu_count() or 1
+    return ProcessPoolExecutor(max_workers=workers,
+                               initializer=init_render_worker,
+                               initargs=(instrument.enabled, workers))
+
+
+# Generate images in parallel, with progress shown in a single bar.
+# Every finished chunk is recorded in the journals right away,
+# so an interrupted run resumes where it stopped
+def render_jobs(jobs: List[Job], outputs: List[Output],
+                workers: Optional[int] = RENDER_WORKERS) -> Dict[str, int]:
+    stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+    if not jobs:
+        return stats
+
+    journals = {width: output_paths['journal']
+                for width, _, output_paths in outputs}
+    widths = [width for width, _, _ in outputs[1:]]
+    # Images sharing their lower layers are rendered one after the other,
+    # so each shared prefix is composited once per chunk
+    jobs = sorted(jobs, key=lambda job: job[1])
+    chunks = [jobs[i:i + RENDER_CHUNK_SIZE]
+              for i in range(0, len(jobs), RENDER_CHUNK_SIZE)]
+    bar = ProgressBar(max_value=len(jobs)).start()
+    done = 0
+    if workers == 1 or len(chunks) == 1:
+        results = (render_chunk(chunk, widths) for chunk in chunks)
+        pool = None
+    else:
+        pool = get_render_pool(workers)
+        results = (future.result() for future in as_completed(
+            [pool.submit(render_chunk, chunk, widths) for chunk in chunks]))
+    try:
+        for entries, chunk_stats in results:
+            for width, width_entries in entries.items():
+                append_journal(journals[width], width_entries)
+            instrument.merge(chunk_stats['instruments'])
+            done += chunk_stats['images']
+            for key in stats:
+                stats[key] += chunk_stats[key]
+            bar.update(done)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    bar.finish()
+    print()
+    return stats
+
+
+def generate_images(paths: Dict[str, str], zfill_count: int,
+                    workers: Optional[int] = RENDER_WORKERS,
+                    profile: str = ENCODING_PROFILE,
+                    ids: Optional[List[str]] = None,
+                    variants: Sequence[Tuple[int, Optional[str]]] = (
+                        IMAGE_VARIANTS)) -> Dict[str, int]:
+    profile, variants = record_encoding(paths, profile, variants)
+    jobs = get_render_jobs(load_edition_data(paths), paths, zfill_count,
+                           profile, ids, variants)
+    edition_name = get_edition_name_to_print(paths['images'])
+    print(f'Generating `{edition_name}` images')
+    with instrument.stage('images', paths) as record:
+        record.items = len(jobs)
+        return render_jobs(jobs, get_outputs(paths, profile, variants),
+                           workers)
+
+
+def images_main(version_path: str, edition_name: Optional[str] = None,
+                workers: Optional[int] = RENDER_WORKERS,
+                profile: Optional[str] = None,
+                ids: Optional[List[str]] = None,
+                verify: bool = False,
+                variants: Sequence[Tuple[int, Optional[str]]] = (
+                    IMAGE_VARIANTS)) -> None:
     if edition_name is None:
         edition_name = choose_edition(version_path)
 
     paths = generate_paths(version_path, edition_name)
-    all_data = load_json_data(paths['json'])
-    zfill_count = len(str(len(all_data.keys())))
-
-    if randomized(version_path, paths['images'], edition_name):
-        if permission('Create images for all groups'):
-            for d in os.listdir(paths['images']):
-                dir_path = os.path.join(paths['images'], d)
-                json_path = os.path.join(dir_path, 'assets.json')
-                generate_images(json_path, dir_path, zfill_count)
-        else:
-            dir_path = os.path.join(paths['images'],
-                                    choose_dir(paths['images'], 'group'))
-            json_path = os.path.join(dir_path, 'assets.json')
-            generate_images(json_path, dir_path, zfill_count)
-    else:
-        generate_images(paths['json'], paths['images'], zfill_count)
+    profile, variants = record_encoding(paths, profile, variants)
+    all_data = load_edition_data(paths)
+    zfill_count = len(str(len(all_data)))
+    outputs = get_outputs(paths, profile, variants)
+    if verify:
+        # Corrupt images are dropped from the journals and rendered again
+        for _, _, output_paths in outputs:
+            if os.path.exists(output_paths['journal']):
+                verify_journal(output_paths)
 
+    # Images of every group are generated into the images folder,
+    # group membership only comes from the manifest
+    groups = {}
+    if randomized(version_path, paths, edition_name):
+        groups = load_groups(paths)
+        if not permission('Create images for all groups'):
+            group = choose_dir(paths['groups'], 'group', lambda _: {
+                str(i): g for i, g in enumerate(groups, start=1)})
+            groups = {group: groups[group]}
+            if ids is None:
+                ids = groups[group]
+            else:
+                ids = [i for i in groups[group] if i in set(ids)]
+    jobs = get_render_jobs(all_data, paths, zfill_count, profile, ids,
+                           variants)
+    print(f'Generating `{edition_name}` images')
+    with instrument.stage('images', paths) as record:
+        record.items = len(jobs)
+        stats = render_jobs(jobs, outputs, workers)
+    if groups and MATERIALIZE_GROUPS:
+        materialize_groups(paths, groups, all_data)
+    print_cache_stats(stats)
 
-def all_images_exist(version_path: str, edition_name: str,
-                     all_data: Dict[str, List[str]]) -> bool:
-    img_path = generate_paths(version_path, edition_name)['images']
-    data_len = len(all_data)
-    groups = randomize_check(img_path)
-    try:
-        if groups:
-            num_groups = len(groups)
-            if num_groups == 1:
-                return len(os.listdir(os.path.join(img_path,
-                                                groups[0]))) == data_len
-            return ((len(os.listdir(os.path.join(img_path, groups[0])))
-                    * (num_groups - 1)
-                    + len(os.listdir(os.path.join(img_path, groups[-1]))))
-                    == data_len)
-        return len(os.listdir(img_path)) == data_len
-    except FileNotFoundError:
-        return False
 
+# Check that every image of the edition was rendered at every size,
+# from the journals alone
+def all_images_exist(version_path: str, edition_name: str,
+                     edition_size: int,
+                     variants: Sequence[Tuple[int, Optional[str]]] = (
+                         IMAGE_VARIANTS)) -> bool:
+    paths = generate_paths(version_path, edition_name)
+    # Images of old group folders are moved back before they are adopted
+    load_groups(paths)
+    ids = [str(i) for i in range(1, edition_size + 1)]
+    for _, profile, output_paths in get_outputs(
+            paths, get_edition_profile(paths),
+            get_edition_variants(paths, variants)):
+        names = get_image_names(ids, len(str(edition_size)), profile)
+        if len(get_finished_ids(load_journal(output_paths, names),
+                                names)) != edition_size:
+            return False
+    return True
 
 
 if __name__ == '__main__':
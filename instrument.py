@@ -0,0 +1,218 @@
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+import json
+import os
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+from config import INSTRUMENTATION, PROFILE_INTERVAL, PROFILE_STAGE
+from utils import atomic_write
+
+# Timers and counters the hot paths report into.
+# Nothing is recorded unless instrumentation is enabled, in which case every
+# stage run in this process is added to a report saved in the edition folder:
+# {'stages': {stage: {'seconds', 'items', 'per_second'}},
+#  'timers': {timer: {'calls', 'seconds', 'self_seconds'}},
+#  'counters': {counter: value},
+#  'derived': {rejection rate, bytes per image, ...}}
+# Timers nest, `self_seconds` leaves out the time spent in inner timers,
+# so rendering splits into decode, composite and encode time.
+# Worker processes send what they recorded back with their results
+
+NULL_TIMER = nullcontext()
+
+enabled = INSTRUMENTATION
+lock = threading.Lock()
+local = threading.local()
+timers: Dict[str, List[float]] = {}
+counters: Counter = Counter()
+stages: Dict[str, Dict[str, float]] = {}
+report_edition: Optional[str] = None
+
+
+def enable(on: bool = True) -> None:
+    global enabled
+    enabled = on
+
+
+def reset() -> None:
+    with lock:
+        timers.clear()
+        counters.clear()
+        stages.clear()
+
+
+# Start a worker process. Forked workers inherit what the parent recorded
+# so far, which must not be sent back to it
+def init_worker(on: bool) -> None:
+    reset()
+    enable(on)
+
+
+class Timer:
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __enter__(self) -> 'Timer':
+        stack = getattr(local, 'stack', None)
+        if stack is None:
+            stack = local.stack = []
+        # Time spent in inner timers
+        stack.append(0.0)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        elapsed = time.perf_counter() - self.start
+        stack = local.stack
+        inner = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        with lock:
+            entry = timers.setdefault(self.name, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] += elapsed - inner
+
+
+def timer(name: str) -> Any:
+    return Timer(name) if enabled else NULL_TIMER
+
+
+def count(name: str, n: int = 1) -> None:
+    if enabled:
+        with lock:
+            counters[name] += n
+
+
+# Take what this process recorded so far, to send it to the parent process
+def collect() -> Optional[Dict[str, Any]]:
+    if not enabled:
+        return None
+    with lock:
+        snapshot = {'timers': {name: list(entry)
+                               for name, entry in timers.items()},
+                    'counters': dict(counters)}
+        timers.clear()
+        counters.clear()
+    return snapshot
+
+
+def merge(snapshot: Optional[Dict[str, Any]]) -> None:
+    if not snapshot:
+        return
+    with lock:
+        for name, (calls, seconds, self_seconds) in (
+                snapshot['timers'].items()):
+            entry = timers.setdefault(name, [0, 0.0, 0.0])
+            entry[0] += calls
+            entry[1] += seconds
+            entry[2] += self_seconds
+        counters.update(snapshot['counters'])
+
+
+# Sample the stack of a thread at a fixed interval.
+# Stacks are saved in the collapsed format flame graph tools read,
+# one `outer;...;inner count` line per distinct stack.
+# Only the thread running the stage is sampled, not worker processes
+class SamplingProfiler(threading.Thread):
+    def __init__(self, interval: float = PROFILE_INTERVAL) -> None:
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.target = threading.get_ident()
+        self.samples: Counter = Counter()
+        self.done = threading.Event()
+
+    def run(self) -> None:
+        while not self.done.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:'
+                             f'{code.co_name}')
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def stop(self) -> None:
+        self.done.set()
+        self.join()
+
+    def save(self, path: str) -> None:
+        with open(path, 'w') as file:
+            for stack, samples in self.samples.most_common():
+                file.write(f'{stack} {samples}\n')
+
+
+def get_derived() -> Dict[str, float]:
+    derived = {}
+    if counters['generate.candidates']:
+        derived['rejection_rate'] = (1 - counters['generate.accepted']
+                                     / counters['generate.candidates'])
+    if counters['render.images']:
+        derived['bytes_per_image'] = (counters['render.bytes']
+                                      / counters['render.images'])
+    for name in ('decode', 'composite', 'encode', 'write'):
+        entry = timers.get(f'render.{name}')
+        if entry is not None and counters['render.images']:
+            derived[f'{name}_ms_per_image'] = (
+                entry[2] * 1000 / counters['render.images'])
+    return derived
+
+
+def write_report(path: str) -> None:
+    with lock:
+        report = {
+            'stages': {name: dict(stage) for name, stage in stages.items()},
+            'timers': {name: {'calls': calls, 'seconds': seconds,
+                              'self_seconds': self_seconds}
+                       for name, (calls, seconds, self_seconds)
+                       in sorted(timers.items())},
+            'counters': dict(sorted(counters.items())),
+            'derived': get_derived()}
+    with atomic_write(path) as file:
+        json.dump(report, file, indent=2)
+
+
+class StageRecord:
+    def __init__(self) -> None:
+        self.items = 0
+
+
+# Time a stage of a run on an edition and save the report once it is done.
+# The report covers every stage run in this process on the same edition.
+# The stage named by PROFILE_STAGE also runs under the sampling profiler
+@contextmanager
+def stage(name: str, paths: Dict[str, str]) -> Iterator[StageRecord]:
+    global report_edition
+    record = StageRecord()
+    if not enabled:
+        yield record
+        return
+
+    if report_edition != paths['edition']:
+        reset()
+        report_edition = paths['edition']
+    profiler = None
+    if name == PROFILE_STAGE:
+        profiler = SamplingProfiler()
+        profiler.start()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        seconds = time.perf_counter() - start
+        if profiler is not None:
+            profiler.stop()
+            profiler.save(os.path.join(paths['edition'],
+                                       f'profile {name}.txt'))
+        stages[name] = {'seconds': seconds, 'items': record.items,
+                        'per_second': record.items / seconds
+                        if seconds else 0.0}
+        if os.path.exists(paths['edition']):
+            write_report(paths['report'])
+    print(f'{name}: {record.items} items in {seconds:.2f}s'
+          f' ({stages[name]["per_second"]:.1f}/s)')
@@ -0,0 +1,149 @@
+import os
+from typing import Dict, List, NamedTuple, Optional
+
+from progressbar import ProgressBar
+
+from utils import (atomic_write, choose_edition, choose_version,
+                   generate_paths, hash_files)
+
+# The render journal is an append-only log in the edition folder.
+# Every line records an image once it is completely written:
+#   id <tab> file name <tab> size in bytes <tab> sha256
+# Images are only journaled after they were renamed into place, so a crash
+# at any point leaves at most one torn line at the end, which is ignored
+
+HASH_LENGTH = 64
+
+
+class JournalEntry(NamedTuple):
+    name: str
+    size: int
+    sha256: str
+
+
+def format_entry(idx: str, entry: JournalEntry) -> str:
+    return f'{idx}\t{entry.name}\t{entry.size}\t{entry.sha256}\n'
+
+
+# Read the journal of an edition. Later entries of an id replace earlier ones
+def read_journal(path: str) -> Dict[str, JournalEntry]:
+    entries = {}
+    try:
+        with open(path, 'r') as file:
+            for line in file:
+                fields = line.rstrip('\n').split('\t')
+                if (not line.endswith('\n') or len(fields) != 4
+                        or len(fields[3]) != HASH_LENGTH
+                        or not fields[2].isdigit()):
+                    continue
+                entries[fields[0]] = JournalEntry(fields[1], int(fields[2]),
+                                                  fields[3])
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+# Append entries and make sure they reached the disk before returning.
+# A torn line left by a crash is ended first, so it stays on its own line
+def append_journal(path: str, entries: Dict[str, JournalEntry]) -> None:
+    if entries:
+        with open(path, 'ab+') as file:
+            data = ''.join(format_entry(idx, entry)
+                           for idx, entry in entries.items())
+            if file.seek(0, os.SEEK_END):
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b'\n':
+                    data = '\n' + data
+            file.write(data.encode())
+            file.flush()
+            os.fsync(file.fileno())
+
+
+# Replace the whole journal, dropping superseded and invalid entries
+def rewrite_journal(path: str, entries: Dict[str, JournalEntry]) -> None:
+    with atomic_write(path, sync=True) as file:
+        file.writelines(format_entry(idx, entry)
+                        for idx, entry in entries.items())
+
+
+# Hash images in parallel, by id. Missing images are left out
+def hash_images(paths: Dict[str, str],
+                bar: Optional[ProgressBar] = None) -> Dict[str, JournalEntry]:
+    hashes = hash_files(list(paths.values()), bar)
+    return {idx: JournalEntry(os.path.basename(path), *hashes[path][:2])
+            for idx, path in paths.items() if path in hashes}
+
+
+# Editions rendered before the journal existed have images but no journal.
+# Hash the images that are already there once, so they are not rendered again
+def adopt_images(paths: Dict[str, str], names: Dict[str, str]
+                 ) -> Dict[str, JournalEntry]:
+    try:
+        existing = set(os.listdir(paths['images']))
+    except FileNotFoundError:
+        existing = set()
+    found = {i: os.path.join(paths['images'], name)
+             for i, name in names.items() if name in existing}
+    if not found:
+        return {}
+
+    print('Recording existing images in the render journal')
+    bar = ProgressBar(max_value=len(found)).start()
+    entries = hash_images(found, bar)
+    bar.finish()
+    print()
+    rewrite_journal(paths['journal'], entries)
+    return entries
+
+
+# Get the journal of an edition, creating it from existing images if needed
+def load_journal(paths: Dict[str, str], names: Dict[str, str]
+                 ) -> Dict[str, JournalEntry]:
+    if os.path.exists(paths['journal']):
+        return read_journal(paths['journal'])
+    return adopt_images(paths, names)
+
+
+# Get the ids whose journaled image is the one currently expected.
+# Nothing but the journal is read
+def get_finished_ids(journal: Dict[str, JournalEntry],
+                     names: Dict[str, str]) -> List[str]:
+    return [i for i, name in names.items()
+            if i in journal and journal[i].name == name]
+
+
+# Check every journaled image against its recorded size and checksum.
+# Missing, truncated or modified images are dropped from the journal,
+# so the next render run generates them again. Returns the dropped ids
+def verify_journal(paths: Dict[str, str]) -> List[str]:
+    journal = read_journal(paths['journal'])
+    print('Verifying rendered images')
+    bar = ProgressBar(max_value=len(journal)).start()
+    hashes = hash_images({i: os.path.join(paths['images'], entry.name)
+                          for i, entry in journal.items()}, bar)
+    bar.finish()
+    print()
+    valid = {i: entry for i, entry in journal.items()
+             if hashes.get(i) == entry}
+    rewrite_journal(paths['journal'], valid)
+    return [i for i in journal if i not in valid]
+
+
+def verify_images(version_path: str,
+                  edition_name: Optional[str] = None) -> None:
+    if edition_name is None:
+        edition_name = choose_edition(version_path)
+
+    if edition_name:
+        paths = generate_paths(version_path, edition_name)
+        invalid = verify_journal(paths)
+        if invalid:
+            print(f'{len(invalid)} images are missing or corrupt and will be'
+                  f' generated again: {", ".join(invalid)}')
+        else:
+            print('All rendered images are intact.')
+
+
+if __name__ == '__main__':
+    verify_images(choose_version())
+    print('Task complete!')
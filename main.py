@@ -1,10 +1,11 @@
 import os
 from assets import create_edition_data
+from edition import get_edition_size
 from images import all_images_exist, images_main
 from metadata import create_metadata_files
 from randomizer import create_random_groups
 from utils import (choose_edition, choose_version, create_dir,
-                   extract_prev_data, get_edition_dirs, permission)
+                   generate_paths, get_edition_dirs, permission)
 
 def main():
     version_path = choose_version()
@@ -16,18 +17,23 @@ def main():
         edition_name = choose_edition(version_path)
 
     if edition_name:
-        prev_data = extract_prev_data(version_path, edition_name)
-        if all_images_exist(version_path, edition_name, prev_data):
-            create_edition_data(version_path, edition_name, prev_data)
+        paths = generate_paths(version_path, edition_name)
+        edition_size = get_edition_size(paths)
+        # Only new avatars need images and metadata after extending
+        new_ids = None
+        if all_images_exist(version_path, edition_name, edition_size):
+            create_edition_data(version_path, edition_name, extend=True)
+            new_ids = [str(i) for i in range(edition_size + 1,
+                                             get_edition_size(paths) + 1)]
         if permission('Create images'):
-            images_main(version_path, edition_name)
+            images_main(version_path, edition_name, ids=new_ids)
             print("Task complete!\n")
         else:
             if permission('Create randomized groups'):
                 create_random_groups(version_path, edition_name)
 
         if permission('Create metadata files'):
-            create_metadata_files(version_path, edition_name)
+            create_metadata_files(version_path, edition_name, ids=new_ids)
             print('Task complete!')
 
 
@@ -0,0 +1,248 @@
+from base64 import b32encode
+import hashlib
+import json
+import os
+from stat import S_ISREG
+from typing import Any, Dict, List, Optional, Tuple
+
+from progressbar import ProgressBar
+
+from utils import (atomic_write, choose_edition, choose_version,
+                   generate_paths, hash_files, permission)
+
+# The manifest records the content address of every rendered image and
+# metadata file of an edition, saved in the edition folder:
+# {'version': MANIFEST_VERSION,
+#  'files': {path relative to the edition folder: {'size', 'mtime',
+#                                                  'sha256', 'cid'}}}
+# Only files whose size or mtime changed are hashed again.
+# CIDs are the ones IPFS gives a file added with --cid-version=1: the file
+# is split into blocks of 256KiB with the default chunker, stored as raw
+# leaves and linked together by a balanced tree of UnixFS dag-pb nodes.
+# A file that fits in a single block is its own raw leaf
+
+MANIFEST_VERSION = 2
+BLOCK_SIZE = 262144
+# Most links a UnixFS node holds with the balanced layout
+LINKS_PER_NODE = 174
+# CIDv1 prefixes of the raw (0x55) and dag-pb (0x70) codecs,
+# with a sha2-256 multihash (0x12) of 32 bytes
+RAW_CID_PREFIX = bytes([0x01, 0x55, 0x12, 0x20])
+DAG_PB_CID_PREFIX = bytes([0x01, 0x70, 0x12, 0x20])
+ManifestEntry = Dict[str, Any]
+# CID in binary, size of the whole serialized DAG and size of the file
+DagNode = Tuple[bytes, int, int]
+
+
+def get_cid(cid: bytes) -> str:
+    return 'b' + b32encode(cid).decode().lower().rstrip('=')
+
+
+# Protobuf fields, as dag-pb and UnixFS serialize them
+def encode_varint(value: int) -> bytes:
+    data = bytearray()
+    while value > 0x7f:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def encode_int_field(number: int, value: int) -> bytes:
+    return encode_varint(number << 3) + encode_varint(value)
+
+
+def encode_bytes_field(number: int, value: bytes) -> bytes:
+    return encode_varint(number << 3 | 2) + encode_varint(len(value)) + value
+
+
+# Link children in a UnixFS file node. Links are serialized before the data,
+# with an empty name and the size of the child's whole DAG
+def get_dag_node(children: List[DagNode]) -> DagNode:
+    file_size = sum(size for _, _, size in children)
+    data = (encode_int_field(1, 2) + encode_int_field(3, file_size)
+            + b''.join(encode_int_field(4, size) for _, _, size in children))
+    block = b''.join(
+        encode_bytes_field(2, encode_bytes_field(1, cid)
+                           + encode_bytes_field(2, b'')
+                           + encode_int_field(3, dag_size))
+        for cid, dag_size, _ in children) + encode_bytes_field(1, data)
+    return (DAG_PB_CID_PREFIX + hashlib.sha256(block).digest(),
+            len(block) + sum(dag_size for _, dag_size, _ in children),
+            file_size)
+
+
+# Every node of the balanced layout but the last one at each depth is full
+def get_balanced_dag(leaves: List[DagNode], depth: int) -> DagNode:
+    if depth == 0:
+        return leaves[0]
+    width = LINKS_PER_NODE ** (depth - 1)
+    return get_dag_node([get_balanced_dag(leaves[i:i + width], depth - 1)
+                         for i in range(0, len(leaves), width)])
+
+
+# Get the CID of a file from the digests of its blocks
+def get_file_cid(blocks: List[bytes], size: int) -> str:
+    sizes = [min(BLOCK_SIZE, size - i)
+             for i in range(0, size, BLOCK_SIZE)] or [0]
+    leaves = [(RAW_CID_PREFIX + digest, block_size, block_size)
+              for digest, block_size in zip(blocks, sizes)]
+    depth = 0
+    while LINKS_PER_NODE ** depth < len(leaves):
+        depth += 1
+    return get_cid(get_balanced_dag(leaves, depth)[0])
+
+
+# Get the folders and files of an edition the manifest covers:
+# images of every size, and metadata in whichever formats were written
+def get_manifest_sources(paths: Dict[str, str]) -> List[str]:
+    sources = [paths['images']]
+    try:
+        sources.extend(sorted(
+            os.path.join(paths['edition'], name)
+            for name in os.listdir(paths['edition'])
+            if name.startswith('images ')))
+    except FileNotFoundError:
+        return []
+    return sources + [paths['metadata'], paths['metadata'] + '.jsonl',
+                      paths['metadata'] + '.zip']
+
+
+# List the files of the given folders and files, by path relative to the
+# edition folder. Group folders and unfinished writes are left out
+def list_files(edition_path: str,
+               sources: List[str]) -> Dict[str, os.stat_result]:
+    files = {}
+    for source in sources:
+        if os.path.isfile(source):
+            entries = [source]
+        elif os.path.isdir(source):
+            entries = [os.path.join(source, name)
+                       for name in sorted(os.listdir(source))
+                       if not name.endswith('.tmp')]
+        else:
+            continue
+        for path in entries:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if S_ISREG(stat.st_mode):
+                files[os.path.relpath(path, edition_path).replace(
+                    os.sep, '/')] = stat
+    return files
+
+
+def load_manifest(path: str) -> Dict[str, ManifestEntry]:
+    try:
+        with open(path, 'r') as file:
+            manifest = json.load(file)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {}
+    return manifest['files']
+
+
+def save_manifest(path: str, files: Dict[str, ManifestEntry]) -> None:
+    with atomic_write(path) as file:
+        json.dump({'version': MANIFEST_VERSION, 'files': files}, file)
+
+
+# Hash files in parallel and get their CIDs, by path relative to the
+# edition folder
+def hash_manifest_files(edition_path: str, names: List[str],
+                        bar: Optional[ProgressBar] = None
+                        ) -> Dict[str, Tuple[str, str]]:
+    paths = {name: os.path.join(edition_path, name) for name in names}
+    hashes = hash_files(list(paths.values()), bar, BLOCK_SIZE)
+    return {name: (hashes[path][1], get_file_cid(hashes[path][2],
+                                                 hashes[path][0]))
+            for name, path in paths.items() if path in hashes}
+
+
+# Bring the manifest of an edition up to date with its files and return it.
+# Files are only hashed if they are new or their size or mtime changed.
+# If sources are given, only the files in them are updated
+def update_manifest(paths: Dict[str, str],
+                    sources: Optional[List[str]] = None
+                    ) -> Dict[str, ManifestEntry]:
+    manifest = load_manifest(paths['manifest'])
+    if sources is None:
+        sources = get_manifest_sources(paths)
+    listed = [os.path.relpath(source, paths['edition']).replace(os.sep, '/')
+              for source in sources]
+    files = list_files(paths['edition'], sources)
+
+    # Drop files of the updated sources that no longer exist
+    updated = {name: entry for name, entry in manifest.items()
+               if name in files or not any(
+                   name == source or name.startswith(source + '/')
+                   for source in listed)}
+    stale = []
+    for name, stat in files.items():
+        entry = manifest.get(name)
+        if (entry is None or entry['size'] != stat.st_size
+                or entry['mtime'] != stat.st_mtime_ns):
+            stale.append(name)
+
+    if stale:
+        print(f'Hashing {len(stale)} files')
+        bar = ProgressBar(max_value=len(stale)).start()
+        hashes = hash_manifest_files(paths['edition'], stale, bar)
+        bar.finish()
+        print()
+        for name, (sha256, cid) in hashes.items():
+            updated[name] = {'size': files[name].st_size,
+                             'mtime': files[name].st_mtime_ns,
+                             'sha256': sha256, 'cid': cid}
+    if updated != manifest:
+        save_manifest(paths['manifest'], updated)
+    return updated
+
+
+# Get the ipfs URI of every image of the manifest, by file name
+def get_image_uris(paths: Dict[str, str],
+                   manifest: Dict[str, ManifestEntry]) -> Dict[str, str]:
+    folder = os.path.relpath(paths['images'], paths['edition']).replace(
+        os.sep, '/') + '/'
+    return {name[len(folder):]: f'ipfs://{entry["cid"]}'
+            for name, entry in manifest.items() if name.startswith(folder)}
+
+
+# Hash every file of the manifest again, whatever its mtime.
+# Returns the files that are missing or whose content changed
+def verify_manifest(paths: Dict[str, str]) -> List[str]:
+    manifest = load_manifest(paths['manifest'])
+    present = [name for name in manifest
+               if os.path.isfile(os.path.join(paths['edition'], name))]
+    print('Verifying manifest')
+    bar = ProgressBar(max_value=len(present)).start()
+    hashes = hash_manifest_files(paths['edition'], present, bar)
+    bar.finish()
+    print()
+    return [name for name, entry in manifest.items()
+            if hashes.get(name) != (entry['sha256'], entry['cid'])]
+
+
+def create_manifest(version_path: str,
+                    edition_name: Optional[str] = None) -> None:
+    if edition_name is None:
+        edition_name = choose_edition(version_path)
+
+    if edition_name:
+        paths = generate_paths(version_path, edition_name)
+        if permission('Verify every file against the manifest'):
+            invalid = verify_manifest(paths)
+            if invalid:
+                print(f'{len(invalid)} files are missing or changed:'
+                      f' {", ".join(invalid)}')
+            else:
+                print('All files match the manifest.')
+        manifest = update_manifest(paths)
+        print(f'{len(manifest)} files recorded in {paths["manifest"]}')
+
+
+if __name__ == '__main__':
+    create_manifest(choose_version())
+    print('Task complete!')
@@ -1,17 +1,24 @@
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 import json
 import os
-from typing import Optional
-import warnings
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+import zipfile
 
-import pandas as pd
-from progressbar import progressbar
+from progressbar import ProgressBar
 
-from config import BASE_JSON
+from config import (BASE_JSON, CONTENT_ADDRESSED_IMAGES, METADATA_FORMAT,
+                    METADATA_WORKERS)
+from edition import EditionData, load_edition_data
+from encoding import get_edition_profile, get_image_name
+import instrument
+from manifest import get_image_uris, update_manifest
 from utils import choose_edition, choose_version, create_dir, generate_paths
 
+METADATA_FORMATS = ('files', 'jsonl', 'zip')
+# Number of items handed to the writing threads at a time
+BATCH_SIZE = 1000
 
-warnings.simplefilter(action='ignore', category=FutureWarning)
 
 # Function to convert snake case to sentence case
 def clean_attributes(attr_name: str) -> str:
@@ -19,54 +26,164 @@ def clean_attributes(attr_name: str) -> str:
                     for word in attr_name.replace('_', ' ').split())
 
 
-# Function to get attribute metadata
-def get_attribute_metadata(csv_path):
-    # Read attribute data from metadata file 
-    df = pd.read_csv(csv_path)
-    df = df.drop('Unnamed: 0', axis = 1)
-    df.columns = [clean_attributes(col) for col in df.columns]
+# Read the attributes of items one at a time, of every item or of the
+# given ids. Yields the item id along with (attribute, value) pairs
+def iter_attribute_rows(edition: EditionData,
+                        ids: Optional[Iterable[str]] = None
+                        ) -> Iterator[Tuple[str, List[Tuple[str, str]]]]:
+    names = [clean_attributes(layer.title()) for layer in edition.layers]
+    for idx in (edition if ids is None else ids):
+        yield idx, list(zip(names, edition.get_names(idx)))
 
-    # Get zfill count based on number of images generated
-    zfill_count = len(str(df.shape[0]))
 
-    return df, zfill_count
+def create_item_json(idx: str, attributes: List[Tuple[str, str]],
+                     zfill_count: int, profile: str,
+                     image_uris: Optional[Dict[str, str]] = None
+                     ) -> Dict[str, Any]:
+    item_json = dict(BASE_JSON)
+    # Append number to base name
+    item_json['name'] = BASE_JSON['name'] + idx
+    image_name = get_image_name(idx, zfill_count, profile)
+    if image_uris is None:
+        # Append image file name to base image path
+        item_json['image'] = BASE_JSON['image'] + '/' + image_name
+    elif image_name in image_uris:
+        item_json['image'] = image_uris[image_name]
+    else:
+        raise ValueError(f'Image {image_name} was not rendered,'
+                         ' its content address is unknown')
+    # Add all existing traits to attributes
+    item_json['attributes'] = [{'trait_type': attr, 'value': value}
+                               for attr, value in attributes
+                               if value != 'none']
+    return item_json
+
+
+# Get the id and json text of every item (or only of the given ids),
+# one at a time
+def iter_metadata(edition: EditionData, zfill_count: int, profile: str,
+                  ids: Optional[Iterable[str]] = None,
+                  image_uris: Optional[Dict[str, str]] = None
+                  ) -> Iterator[Tuple[str, str]]:
+    for idx, attributes in iter_attribute_rows(edition, ids):
+        yield idx, json.dumps(create_item_json(idx, attributes, zfill_count,
+                                               profile, image_uris))
+
+
+# Write a single metadata file.
+# In incremental mode, files that are already up to date are left alone
+def write_metadata_file(path: str, text: str, incremental: bool) -> bool:
+    if incremental:
+        try:
+            with open(path, 'r') as f:
+                if f.read() == text:
+                    return False
+        except FileNotFoundError:
+            pass
+    with open(path, 'w') as f:
+        f.write(text)
+    instrument.count('metadata.files')
+    instrument.count('metadata.bytes', len(text))
+    return True
+
+
+def write_metadata_files(items: Iterator[Tuple[str, str]], metadata_dir: str,
+                         incremental: bool, bar: ProgressBar) -> int:
+    create_dir(metadata_dir)
+    written = done = 0
+    with ThreadPoolExecutor(max_workers=METADATA_WORKERS) as executor:
+        while True:
+            batch = list(islice(items, BATCH_SIZE))
+            if not batch:
+                return written
+            written += sum(executor.map(
+                lambda item: write_metadata_file(
+                    os.path.join(metadata_dir, item[0] + '.json'),
+                    item[1], incremental),
+                batch))
+            done += len(batch)
+            bar.update(done)
+
+
+# Write every item as one line of a single file, for bulk uploads
+def write_metadata_jsonl(items: Iterator[Tuple[str, str]], path: str,
+                         bar: ProgressBar) -> int:
+    written = 0
+    with open(path, 'w') as f:
+        for _, text in items:
+            f.write(text + '\n')
+            instrument.count('metadata.bytes', len(text) + 1)
+            written += 1
+            bar.update(written)
+    return written
+
+
+# Bundle all metadata files into one archive, for bulk uploads
+def write_metadata_zip(items: Iterator[Tuple[str, str]], path: str,
+                       bar: ProgressBar) -> int:
+    written = 0
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for idx, text in items:
+            archive.writestr(f'{idx}.json', text)
+            instrument.count('metadata.bytes', len(text))
+            written += 1
+            bar.update(written)
+    return written
 
 
 # Main function that generates the JSON metadata
 def create_metadata_files(version_path: str,
-                          edition_name: Optional[str] = None) -> None:
+                          edition_name: Optional[str] = None,
+                          output_format: str = METADATA_FORMAT,
+                          incremental: bool = True,
+                          ids: Optional[List[str]] = None,
+                          content_addressed: bool = CONTENT_ADDRESSED_IMAGES
+                          ) -> None:
+    if output_format not in METADATA_FORMATS:
+        raise ValueError(f'Unknown metadata format `{output_format}`')
+
     if edition_name is None:
         edition_name = choose_edition(version_path)
 
     if edition_name:
         paths = generate_paths(version_path, edition_name)
 
-        # Make json folder
-        create_dir(paths['metadata'])
-        # Get attribute data and zfill count
-        df, zfill_count = get_attribute_metadata(paths['csv'])
+        # Get zfill count based on number of images generated
+        edition = load_edition_data(paths)
+        count = len(edition)
+        zfill_count = len(str(count))
+        profile = get_edition_profile(paths)
+        if ids is not None and output_format == 'files':
+            # Bundled formats always hold the whole edition
+            ids = sorted(set(ids), key=int)
+            count = len(ids)
+        else:
+            ids = None
+        image_uris = None
+        if content_addressed:
+            image_uris = get_image_uris(
+                paths, update_manifest(paths, [paths['images']]))
+        items = iter_metadata(edition, zfill_count, profile, ids, image_uris)
 
         print('Creating metadata files.')
-        for idx, row in progressbar(df.iterrows()):
-            # Get a copy of the base JSON (python dict)
-            item_json = deepcopy(BASE_JSON)
-            # Append number to base name
-            item_json['name'] = item_json['name'] + str(idx)
-            # Append image PNG file name to base image path
-            item_json['image'] = (item_json['image'] + '/'
-                                  + str(idx).zfill(zfill_count) + '.png')
-            # Convert pandas series to dictionary
-            attr_dict = dict(row)
-            # Add all existing traits to attributes dictionary
-            for attr in attr_dict:
-                if attr_dict[attr] != 'none':
-                    item_json['attributes'].append({ 'trait_type': attr,
-                                                    'value': attr_dict[attr] })
-            # Write file to json folder
-            item_json_path = os.path.join(paths['metadata'],
-                                          str(idx + 1) + '.json')
-            with open(item_json_path, 'w') as f:
-                json.dump(item_json, f)
+        with instrument.stage('metadata', paths) as record:
+            bar = ProgressBar(max_value=count).start()
+            if output_format == 'jsonl':
+                written = write_metadata_jsonl(
+                    items, paths['metadata'] + '.jsonl', bar)
+            elif output_format == 'zip':
+                written = write_metadata_zip(
+                    items, paths['metadata'] + '.zip', bar)
+            else:
+                written = write_metadata_files(items, paths['metadata'],
+                                               incremental, bar)
+            bar.finish()
+            record.items = count
+        print(f'\n{written} of {count} metadata files written.')
+        if content_addressed:
+            # Record the metadata files too, for checking uploads
+            update_manifest(paths)
+
 
 if __name__ == '__main__':
     create_metadata_files(choose_version())
@@ -0,0 +1,402 @@
+import argparse
+from concurrent.futures import (FIRST_COMPLETED, Future, ThreadPoolExecutor,
+                                wait)
+import json
+import os
+from queue import Empty, Full, Queue
+from threading import Event
+import time
+from typing import (Any, Dict, Iterator, List, Optional, Sequence, Set,
+                    Tuple)
+
+import numpy as np
+from progressbar import NullBar, ProgressBar
+
+from assets import (get_total_combinations, get_trait_data, iter_asset_data,
+                    load_edition, parse_config, UniqueIndex)
+from config import (CONTENT_ADDRESSED_IMAGES, EDITION_EXPORTS, EDITION_SEED,
+                    IMAGE_VARIANTS, METADATA_FORMAT, RENDER_CHUNK_SIZE,
+                    RENDER_WORKERS)
+from edition import (edition_exists, EditionSeed, EXPORT_FORMATS,
+                     get_edition_size, load_edition_data, save_edition_state,
+                     update_exports)
+from encoding import (get_edition_profile, get_edition_variants,
+                      record_encoding)
+from images import (get_finished_images, get_missing_jobs, get_output_files,
+                    get_outputs, get_render_pool, Job, Output,
+                    parse_variants, print_cache_stats, render_chunk)
+import instrument
+from journal import append_journal, verify_journal
+from metadata import (clean_attributes, create_item_json,
+                      create_metadata_files, iter_attribute_rows,
+                      METADATA_FORMATS, write_metadata_files,
+                      write_metadata_jsonl, write_metadata_zip)
+from utils import create_dir, erase_edition, generate_paths
+
+# Non-interactive runner that streams an edition through all stages at once.
+# Accepted trait sets go from the generator thread to the render processes
+# and the metadata thread through bounded queues, so the stages overlap and
+# memory stays flat. The files written are the same as with main.py
+
+STAGES = ('generate', 'images', 'metadata')
+# Number of batches or items waiting between two stages
+QUEUE_SIZE = 4
+METADATA_QUEUE_SIZE = 10000
+# Stands for the end of a stream in a queue
+DONE = None
+
+# Id, attributes and layer paths of an item
+Item = Tuple[str, List[Tuple[str, str]], List[str]]
+
+
+# Put an item in a queue unless the pipeline is being stopped
+def put(queue: Queue, item: Any, stop: Event) -> None:
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return
+        except Full:
+            continue
+
+
+# Get the items of a queue until the end of the stream
+def drain(queue: Queue, stop: Event) -> Iterator[Any]:
+    while not stop.is_set():
+        try:
+            item = queue.get(timeout=0.1)
+        except Empty:
+            continue
+        if item is DONE:
+            return
+        yield item
+
+
+def produce(items: Iterator[Any], queue: Queue, stop: Event) -> None:
+    try:
+        for item in items:
+            put(queue, item, stop)
+            if stop.is_set():
+                return
+    finally:
+        put(queue, DONE, stop)
+
+
+def write_metadata_stream(items: Iterator[Tuple[str, str]],
+                          paths: Dict[str, str], output_format: str) -> int:
+    if output_format == 'jsonl':
+        return write_metadata_jsonl(items, paths['metadata'] + '.jsonl',
+                                    NullBar())
+    if output_format == 'zip':
+        return write_metadata_zip(items, paths['metadata'] + '.zip',
+                                  NullBar())
+    return write_metadata_files(items, paths['metadata'], True, NullBar())
+
+
+# Render chunks of images in worker processes, keeping a bounded number
+# of chunks in flight. Finished chunks are recorded in the render journals
+class Renderer:
+    def __init__(self, outputs: List[Output], workers: Optional[int]):
+        self.journals = {width: output_paths['journal']
+                         for width, _, output_paths in outputs}
+        self.widths = [width for width, _, _ in outputs[1:]]
+        self.pool = get_render_pool(workers)
+        self.max_pending = 2 * (workers or os.cpu_count() or 1)
+        self.pending: Set[Future] = set()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self.done = 0
+
+    def collect(self, futures: Set[Future]) -> None:
+        for future in futures:
+            entries, chunk_stats = future.result()
+            for width, width_entries in entries.items():
+                append_journal(self.journals[width], width_entries)
+            instrument.merge(chunk_stats['instruments'])
+            self.done += chunk_stats['images']
+            for key in self.stats:
+                self.stats[key] += chunk_stats[key]
+        self.pending -= futures
+
+    def submit(self, jobs: List[Job]) -> None:
+        # Images sharing their lower layers are rendered one after the other
+        jobs = sorted(jobs, key=lambda job: job[1])
+        for i in range(0, len(jobs), RENDER_CHUNK_SIZE):
+            while len(self.pending) >= self.max_pending:
+                done, _ = wait(self.pending, return_when=FIRST_COMPLETED)
+                self.collect(done)
+            self.pending.add(self.pool.submit(
+                render_chunk, jobs[i:i + RENDER_CHUNK_SIZE], self.widths))
+
+    def finish(self) -> None:
+        self.collect(set(self.pending))
+        self.pool.shutdown()
+
+    def cancel(self) -> None:
+        self.pool.shutdown(cancel_futures=True)
+
+
+# Get the edition to stream, creating or extending it if generating
+def prepare_edition(version_path: str, edition_name: str, stages: List[str],
+                    count: int, extend: bool, force: bool
+                    ) -> Tuple[Dict[str, str], int]:
+    paths = generate_paths(version_path, edition_name)
+    exists = edition_exists(paths)
+    if 'generate' not in stages or extend:
+        if not exists:
+            raise FileNotFoundError(f'Edition `{edition_name}` does not exist')
+        return paths, get_edition_size(paths)
+    if exists:
+        if not force:
+            raise FileExistsError(f'Edition `{edition_name}` already exists,'
+                                  ' use --extend or --force')
+        erase_edition(version_path, edition_name)
+    if count <= 0:
+        raise ValueError('The number of avatars to generate must be positive')
+    create_dir(paths['edition'])
+    return paths, 0
+
+
+# Stream the new items of a generated edition as they come, saving the
+# edition once complete. Yields the ids, attributes and layer paths of items
+def stream_generated(paths: Dict[str, str], edition_config, count: int,
+                     existing: int, traits: np.ndarray,
+                     unique_index: UniqueIndex, seed: EditionSeed,
+                     stop: Event) -> Iterator[List[Item]]:
+    names = [clean_attributes(layer['name'].title())
+             for layer in edition_config]
+
+    batches = Queue(QUEUE_SIZE)
+    rows = []
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        generator = executor.submit(produce, iter_asset_data(
+            edition_config, count, unique_index, seed), batches, stop)
+        for batch in drain(batches, stop):
+            items = []
+            for row in batch:
+                rows.append(row)
+                values, data = get_trait_data(edition_config, row)
+                items.append((str(existing + len(rows)),
+                              list(zip(names, values)), data))
+            yield items
+        generator.result()
+
+    traits = np.concatenate([traits, np.array(rows, dtype=np.intp)
+                             .reshape(-1, len(edition_config))])
+    ranks = None
+    if get_total_combinations(edition_config) < 2 ** 63:
+        ranks = unique_index.ranks()
+    save_edition_state(paths, edition_config, traits, ranks, seed)
+
+
+# Stream the items of an existing edition
+def stream_existing(paths: Dict[str, str],
+                    batch_size: int = RENDER_CHUNK_SIZE * 32
+                    ) -> Iterator[List[Item]]:
+    edition = load_edition_data(paths)
+    batch = []
+    for idx, attributes in iter_attribute_rows(edition):
+        batch.append((idx, attributes, edition[idx]))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def run_pipeline(version_path: str, edition_name: str,
+                 stages: List[str] = list(STAGES), count: int = 0,
+                 extend: bool = False, force: bool = False,
+                 workers: Optional[int] = RENDER_WORKERS,
+                 profile: Optional[str] = None,
+                 metadata_format: str = METADATA_FORMAT,
+                 verify: bool = False,
+                 seed: Optional[int] = EDITION_SEED,
+                 exports: Tuple[str, ...] = EDITION_EXPORTS,
+                 variants: Sequence[Tuple[int, Optional[str]]] = (
+                     IMAGE_VARIANTS)) -> Dict[str, float]:
+    start = time.perf_counter()
+    paths, existing = prepare_edition(version_path, edition_name, stages,
+                                      count, extend, force)
+    edition_config = None
+    if 'generate' in stages:
+        edition_config = parse_config(version_path)
+        zfill_count = len(str(existing + count))
+    else:
+        zfill_count = len(str(existing))
+    # Only rendering records the encoding, so later stages use the one
+    # the images were rendered with
+    if 'images' in stages:
+        profile, variants = record_encoding(paths, profile, variants)
+    else:
+        profile = get_edition_profile(paths, profile)
+        variants = get_edition_variants(paths, variants)
+    outputs = get_outputs(paths, profile, variants)
+    if verify and 'images' in stages:
+        for _, _, output_paths in outputs:
+            if os.path.exists(output_paths['journal']):
+                verify_journal(output_paths)
+    # Bundled metadata formats hold the whole edition,
+    # so they are written once an extended edition is complete.
+    # Content addressed images are only known once rendered
+    stream_metadata = 'metadata' in stages and not (
+        extend and metadata_format != 'files'
+        or CONTENT_ADDRESSED_IMAGES)
+
+    stop = Event()
+    renderer = None
+    if 'images' in stages:
+        renderer = Renderer(outputs, workers)
+    metadata_queue = Queue(METADATA_QUEUE_SIZE)
+    metadata_executor = ThreadPoolExecutor(max_workers=1)
+    metadata_writer = None
+    if stream_metadata:
+        metadata_writer = metadata_executor.submit(
+            write_metadata_stream, drain(metadata_queue, stop), paths,
+            metadata_format)
+
+    if edition_config is not None:
+        if extend:
+            traits, unique_index, edition_seed = load_edition(paths,
+                                                              edition_config)
+        else:
+            traits = np.empty((0, len(edition_config)), dtype=np.intp)
+            unique_index = UniqueIndex(edition_config)
+            edition_seed = EditionSeed(seed)
+        batches = stream_generated(paths, edition_config, count, existing,
+                                   traits, unique_index, edition_seed, stop)
+        total = count
+    else:
+        batches = stream_existing(paths)
+        total = existing
+
+    # Images already in the render journals of an existing edition are
+    # skipped. Journals are read, or created from existing images, once
+    finished = None
+    if renderer is not None:
+        if edition_config is None:
+            finished = get_finished_images(
+                paths, [str(i) for i in range(1, existing + 1)], zfill_count,
+                outputs)
+        else:
+            for _, _, output_paths in outputs:
+                create_dir(output_paths['images'])
+
+    with instrument.stage('pipeline', paths) as record:
+        bar = ProgressBar(max_value=total).start()
+        streamed = 0
+        try:
+            for batch in batches:
+                if renderer is not None:
+                    layers = {idx: data for idx, _, data in batch}
+                    if finished is not None:
+                        jobs = get_missing_jobs(layers, layers, zfill_count,
+                                                outputs, finished)
+                    else:
+                        jobs = [(idx, data, get_output_files(
+                                    idx, zfill_count, outputs))
+                                for idx, data in layers.items()]
+                    renderer.submit(jobs)
+                if metadata_writer is not None:
+                    for idx, attributes, _ in batch:
+                        put(metadata_queue, (idx, json.dumps(create_item_json(
+                            idx, attributes, zfill_count, profile))), stop)
+                streamed += len(batch)
+                bar.update(streamed)
+            record.items = streamed
+            if renderer is not None:
+                renderer.finish()
+            put(metadata_queue, DONE, stop)
+            written = metadata_writer.result() if metadata_writer else 0
+        except BaseException:
+            stop.set()
+            if renderer is not None:
+                renderer.cancel()
+            raise
+        finally:
+            metadata_executor.shutdown()
+        bar.finish()
+        print()
+    if 'metadata' in stages and not stream_metadata:
+        create_metadata_files(version_path, edition_name, metadata_format)
+        written = get_edition_size(paths)
+    if 'generate' in stages:
+        update_exports(paths, exports, existing)
+
+    if renderer is not None:
+        print_cache_stats(renderer.stats)
+    timings = {'items': streamed,
+               'images': renderer.done if renderer else 0,
+               'metadata': written,
+               'seconds': time.perf_counter() - start}
+    print(f'{timings["items"]} items, {timings["images"]} images and'
+          f' {timings["metadata"]} metadata files in'
+          f' {timings["seconds"]:.2f}s')
+    return timings
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Generate an edition, its images and its metadata'
+                    ' in one streaming pass')
+    parser.add_argument('version', help='path of the version folder')
+    parser.add_argument('edition', help='name of the edition')
+    parser.add_argument('-n', '--count', type=int, default=0,
+                        help='number of avatars to generate')
+    parser.add_argument('-s', '--stages', default=','.join(STAGES),
+                        help='comma separated stages to run, out of'
+                             f' {", ".join(STAGES)} (default: all)')
+    parser.add_argument('--extend', action='store_true',
+                        help='add the avatars to an existing edition')
+    parser.add_argument('--force', action='store_true',
+                        help='erase the edition if it already exists')
+    parser.add_argument('-w', '--workers', type=int, default=RENDER_WORKERS,
+                        help='number of render processes')
+    parser.add_argument('-p', '--profile', default=None,
+                        help='encoding profile of new editions')
+    parser.add_argument('-m', '--metadata-format', default=METADATA_FORMAT,
+                        choices=METADATA_FORMATS)
+    parser.add_argument('--seed', type=int, default=EDITION_SEED,
+                        help='seed of a new edition, the same seed always'
+                             ' gives the same edition')
+    parser.add_argument('-e', '--export', default=','.join(EDITION_EXPORTS),
+                        help='comma separated formats the edition is exported'
+                             f' to, out of {", ".join(EXPORT_FORMATS)}')
+    parser.add_argument('--verify', action='store_true',
+                        help='check rendered images against the render'
+                             ' journal and render missing or corrupt ones')
+    parser.add_argument('-r', '--variants',
+                        default=','.join(
+                            f'{width}:{profile}' if profile else str(width)
+                            for width, profile in IMAGE_VARIANTS),
+                        help='comma separated smaller sizes rendered along'
+                             ' with full size images, as width[:profile].'
+                             ' Sizes are recorded with the edition')
+    parser.add_argument('--report', action='store_true',
+                        default=instrument.enabled,
+                        help='record timers and counters and save a report'
+                             ' in the edition folder')
+    args = parser.parse_args()
+    args.stages = [stage.strip() for stage in args.stages.split(',')]
+    for stage in args.stages:
+        if stage not in STAGES:
+            parser.error(f'unknown stage `{stage}`')
+    args.export = tuple(fmt.strip() for fmt in args.export.split(',')
+                        if fmt.strip())
+    for fmt in args.export:
+        if fmt not in EXPORT_FORMATS:
+            parser.error(f'unknown export format `{fmt}`')
+    try:
+        args.variants = parse_variants(args.variants)
+    except ValueError as e:
+        parser.error(str(e))
+    if 'generate' in args.stages and args.count <= 0:
+        parser.error('--count is required to generate avatars')
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    instrument.enable(args.report)
+    run_pipeline(os.path.abspath(args.version), args.edition, args.stages,
+                 args.count, args.extend, args.force, args.workers,
+                 args.profile, args.metadata_format, args.verify, args.seed,
+                 args.export, args.variants)
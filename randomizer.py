@@ -1,71 +1,129 @@
+import json
 import os
-from random import shuffle
-from typing import Dict, List, Optional
+import shutil
+from typing import Dict, List, Mapping, Optional, Tuple
 
+import numpy as np
 from progressbar import progressbar
 
-from config import RANDOMIZED_GROUP_SIZE
+from config import MATERIALIZE_GROUPS, RANDOMIZED_GROUP_SIZE
+from edition import GROUP_STREAM, load_edition_data, load_edition_seed
+from encoding import get_edition_profile, get_image_name
+import instrument
 from utils import (choose_edition, choose_version, create_assets_json,
-                   create_dir, generate_paths, load_json_data, permission)
+                   create_dir, erase_dir, generate_paths, load_json_data,
+                   permission)
 
+# Groups are stored in a manifest file mapping each group to its ids, along
+# with the number of times the edition was re-randomized:
+# {'round': round, 'groups': {group: ids}}
+# Images always stay in the edition's images folder, group folders are
+# optional views made of hard links to them
 
-def group_indices(edition_size: int,
-                  group_size: int) -> List[List[str]]:
-    temp = [str(i + 1) for i in range(edition_size)]
-    shuffle(temp)
 
-    groups = []
-    while len(temp) > group_size:
-        groups.append(list(temp.pop() for _ in range(group_size)))
+def group_indices(edition_size: int, group_size: int,
+                  rng: Optional[np.random.Generator] = None
+                  ) -> List[List[str]]:
+    if rng is None:
+        rng = np.random.default_rng()
+    temp = [str(i + 1) for i in rng.permutation(edition_size)]
 
-    groups.append((temp))
-    return groups
+    # Partition the shuffled indices, the last group takes the remainder
+    return [temp[i:i + group_size]
+            for i in range(0, edition_size, group_size)] or [temp]
+
+
+def get_group_dirs(img_path: str) -> List[str]:
+    try:
+        return sorted(d for d in os.listdir(img_path)
+                      if d.startswith('group ')
+                      and os.path.isdir(os.path.join(img_path, d)))
+    except FileNotFoundError:
+        return []
 
 
-def move_single_image(img_path: str, group_index: str,
-                      reverse : bool = False) -> None:
-    target = img_path
-    destination = os.path.join(os.path.dirname(img_path), 
-                               f'group {group_index}',
-                               os.path.basename(img_path))
-    if reverse:
-        target, destination = destination, target
-    if os.path.exists(target):
-        os.rename(target, destination)
-
-
-def create_group_json(paths: Dict[str, str],  group_index: str,
-                      indices: List[str]) -> None:
-    all_data = load_json_data(paths['json'])
-    json_data = {k: v for k, v in all_data.items() if k in indices}
-    create_assets_json(json_data, os.path.join(
-        paths['images'], f'group {group_index}', 'assets.json'))
-
-
-def create_group(paths: Dict[str, str], group_index: str, indices: List[str],
-                 edition_size: int, reverse: bool = False) -> None:
-    if not reverse:
-        create_dir(os.path.join(paths['images'], f'group {group_index}'))
-        create_group_json(paths, group_index, indices)
-    zfill_count = len(str(edition_size))
-    for i in indices:
-        image_name = str(i).zfill(zfill_count) + '.png'
-        img_path = os.path.join(paths['images'], image_name)
-        move_single_image(img_path, group_index, reverse)
-
-
-def get_prev_randomized_indices(group: str, paths: Dict[str, str]):
-    path = os.path.join(paths['images'], group)
-    return [k for k in load_json_data(path).keys()]
-
-
-def revert_groups(groups: List[str], paths: Dict[str, str],
-                 edition_size: int) -> None:
-    print('Reverting groups')
-    indices = [get_prev_randomized_indices(group, paths) for group in groups]
-    for i, group in progressbar(enumerate(indices, start=1)):
-        create_group(paths, str(i), group, edition_size, reverse=True)
+def write_groups(paths: Dict[str, str], groups: Dict[str, List[str]],
+                 group_round: int = 0) -> None:
+    with open(paths['groups'], 'w') as file:
+        json.dump({'round': group_round, 'groups': groups}, file)
+
+
+# Editions grouped before the manifest existed had their images moved into
+# group folders. Move them back and record the groups in a manifest
+def migrate_group_dirs(paths: Dict[str, str]) -> Dict[str, List[str]]:
+    dirs = get_group_dirs(paths['images'])
+    if not dirs:
+        return {}
+
+    print('Moving grouped images back into the images folder')
+    groups = {}
+    for group in progressbar(dirs):
+        group_path = os.path.join(paths['images'], group)
+        groups[group] = list(load_json_data(
+            os.path.join(group_path, 'assets.json')).keys())
+        for name in os.listdir(group_path):
+            if name != 'assets.json':
+                os.replace(os.path.join(group_path, name),
+                           os.path.join(paths['images'], name))
+        erase_dir(group_path)
     print()
+    write_groups(paths, groups)
+    return groups
+
+
+# Get the groups of an edition and how many times they were re-randomized.
+# Manifests written before rounds were recorded only map groups to ids
+def read_groups(paths: Dict[str, str]) -> Tuple[Dict[str, List[str]], int]:
+    try:
+        with open(paths['groups'], 'r') as file:
+            manifest = json.load(file)
+    except FileNotFoundError:
+        return migrate_group_dirs(paths), 0
+    if 'round' not in manifest:
+        return manifest, 0
+    return manifest['groups'], manifest['round']
+
+
+def load_groups(paths: Dict[str, str]) -> Dict[str, List[str]]:
+    return read_groups(paths)[0]
+
+
+# Check that a group's link (or copy) still refers to the current image
+def is_same_image(source: str, link: str) -> bool:
+    source_stat, link_stat = os.stat(source), os.stat(link)
+    return (os.path.samestat(source_stat, link_stat)
+            or (source_stat.st_size == link_stat.st_size
+                and source_stat.st_mtime_ns == link_stat.st_mtime_ns))
+
+
+# Create group folders of hard links to the edition's images,
+# along with the group's share of assets.json
+def materialize_groups(paths: Dict[str, str], groups: Dict[str, List[str]],
+                       all_data: Mapping[str, List[str]]) -> None:
+    zfill_count = len(str(len(all_data)))
+    profile = get_edition_profile(paths)
+    for group, indices in groups.items():
+        group_path = os.path.join(paths['images'], group)
+        create_dir(group_path)
+        create_assets_json({k: all_data[k] for k in indices},
+                           os.path.join(group_path, 'assets.json'))
+        for i in indices:
+            image_name = get_image_name(i, zfill_count, profile)
+            source = os.path.join(paths['images'], image_name)
+            link = os.path.join(group_path, image_name)
+            if not os.path.exists(source):
+                continue
+            if os.path.exists(link):
+                # Images rendered again replace the file a link points to
+                if is_same_image(source, link):
+                    continue
+                os.remove(link)
+            try:
+                os.link(source, link)
+            except OSError:
+                # Hard links are not supported everywhere
+                shutil.copy2(source, link)
+
 
 def create_random_groups(version_path: str, edition_name: Optional[str] = None,
                          group_size: int = RANDOMIZED_GROUP_SIZE) -> None:
@@ -74,33 +132,41 @@ def create_random_groups(version_path: str, edition_name: Optional[str] = None,
 
     if edition_name:
         paths = generate_paths(version_path, edition_name)
-        edition_size = len(load_json_data(paths['json']))
-        if os.path.exists(paths['images']):
-            groups = list(filter(lambda x: x.startswith('group'),
-                            os.listdir(paths['images'])))
-            if any(groups):
-                if not permission(
-                'Random groups already exist. Re-randomize'):
-                    return None
-                revert_groups(groups, paths, edition_size)
-        zfill_count = len(str(edition_size // group_size + 1))
-        indices = group_indices(edition_size, group_size)
-        print('Creating groups')
-        for i, group in progressbar(enumerate(indices, start=1)):
-            create_group(paths, str(i).zfill(zfill_count), group, edition_size)
-        print()
-
-
-def randomize_check(img_path: str) -> List[str]:
-    try:
-        return list(filter(lambda x: x.startswith('group '),
-                           os.listdir(img_path)))
-    except FileNotFoundError:
-        return []
+        # Load the edition once and split it into all groups in one pass
+        all_data = load_edition_data(paths)
+        edition_size = len(all_data)
+        groups, group_round = read_groups(paths)
+        if groups:
+            if not permission('Random groups already exist. Re-randomize'):
+                return None
+            group_round += 1
+            # Group folders only hold links, the images themselves stay
+            for group in get_group_dirs(paths['images']):
+                erase_dir(os.path.join(paths['images'], group))
 
-
-def randomized(version_path: str, img_path: str, edition_name: str) -> bool:
-    if randomize_check(img_path):
+        print('Creating groups')
+        with instrument.stage('groups', paths) as record:
+            # Groups come from the edition's seed and the number of times
+            # they were re-randomized, so every grouping can be reproduced.
+            # The first grouping keeps the stream it always had
+            seed = load_edition_seed(paths)
+            key = (GROUP_STREAM, edition_size, group_size)
+            if group_round:
+                key += (group_round,)
+            rng = seed.generator(*key) if seed is not None else None
+            zfill_count = len(str(edition_size // group_size + 1))
+            groups = {f'group {str(i).zfill(zfill_count)}': indices
+                      for i, indices in enumerate(group_indices(
+                          edition_size, group_size, rng), start=1)}
+            write_groups(paths, groups, group_round)
+            if MATERIALIZE_GROUPS:
+                materialize_groups(paths, groups, all_data)
+            record.items = edition_size
+
+
+def randomized(version_path: str, paths: Dict[str, str],
+               edition_name: str) -> bool:
+    if load_groups(paths):
         return True
     if permission('Create randomized groups'):
         create_random_groups(version_path, edition_name)
@@ -0,0 +1,110 @@
+from typing import Dict, List, NamedTuple, Optional
+
+import numpy as np
+
+from edition import load_edition_data
+from utils import (choose_edition, choose_version, create_csv,
+                   generate_paths)
+
+
+# An edition's traits, with one integer code per item and layer.
+# traits[j][codes[i, j]] is the name of the trait of item i in layer j
+class TraitMatrix(NamedTuple):
+    ids: np.ndarray
+    layers: List[str]
+    traits: List[np.ndarray]
+    codes: np.ndarray
+
+
+# The trait indices of an edition are used as codes as they are
+def load_trait_matrix(paths: Dict[str, str]) -> TraitMatrix:
+    edition = load_edition_data(paths)
+    ids = np.arange(1, len(edition) + 1).astype(str)
+    return TraitMatrix(ids, [layer.title() for layer in edition.layers],
+                       [np.array(names) for names in edition.traits],
+                       np.asarray(edition.matrix, dtype=np.intp))
+
+
+# Get the share of items that have each item's trait, per layer
+def get_trait_frequencies(matrix: TraitMatrix) -> np.ndarray:
+    frequencies = np.empty(matrix.codes.shape)
+    for j in range(len(matrix.layers)):
+        counts = np.bincount(matrix.codes[:, j])
+        frequencies[:, j] = counts[matrix.codes[:, j]] / len(matrix.codes)
+    return frequencies
+
+
+# Get the number of actual traits (not `none`) of every item
+def get_trait_counts(matrix: TraitMatrix) -> np.ndarray:
+    counts = np.zeros(len(matrix.codes), dtype=np.intp)
+    for j, names in enumerate(matrix.traits):
+        counts += names[matrix.codes[:, j]] != 'none'
+    return counts
+
+
+# Rank scores from highest to lowest, giving equal scores the same rank
+def rank_scores(scores: np.ndarray) -> np.ndarray:
+    descending = -np.sort(-scores)
+    return np.searchsorted(-descending, -scores, side='left') + 1
+
+
+# Compute all rarity scores of an edition in one pass.
+# - rarity score: sum of 1 / frequency of every trait and of the trait count
+# - statistical rarity: product of trait frequencies (lower is rarer)
+# - information content: bits needed to describe the item's traits
+def score_edition(matrix: TraitMatrix) -> Dict[str, np.ndarray]:
+    frequencies = get_trait_frequencies(matrix)
+    trait_counts = get_trait_counts(matrix)
+    count_frequencies = (np.bincount(trait_counts)[trait_counts]
+                         / max(len(trait_counts), 1))
+
+    rarity_score = (1 / frequencies).sum(axis=1) + 1 / count_frequencies
+    return {
+        'rarity_score': rarity_score,
+        'statistical_rarity': frequencies.prod(axis=1),
+        'trait_count': trait_counts,
+        'information_content': -np.log2(frequencies).sum(axis=1),
+        'rank': rank_scores(rarity_score),
+    }
+
+
+# Write scores as text, and as a binary copy that can be memory-mapped
+def create_score_files(scores: Dict[str, np.ndarray],
+                       paths: Dict[str, str]) -> None:
+    np.savetxt(paths['score'], scores['rarity_score'], fmt='%.6f')
+    np.save(paths['score_array'], scores['rarity_score'])
+
+
+def create_rarity_table(matrix: TraitMatrix, scores: Dict[str, np.ndarray],
+                        path: str) -> None:
+    order = np.lexsort((matrix.ids.astype(int), scores['rank']))
+    rows = [['Rank', 'Id', 'Rarity Score', 'Statistical Rarity',
+             'Trait Count', 'Information Content']]
+    rows.extend(zip(scores['rank'][order].tolist(),
+                    matrix.ids[order].tolist(),
+                    np.round(scores['rarity_score'][order], 6).tolist(),
+                    scores['statistical_rarity'][order].tolist(),
+                    scores['trait_count'][order].tolist(),
+                    np.round(scores['information_content'][order], 6)
+                    .tolist()))
+    create_csv(rows, path)
+
+
+# Main function that scores an edition
+def create_rarity_scores(version_path: str,
+                         edition_name: Optional[str] = None) -> None:
+    if edition_name is None:
+        edition_name = choose_edition(version_path)
+
+    if edition_name:
+        paths = generate_paths(version_path, edition_name)
+        print('Scoring edition.')
+        matrix = load_trait_matrix(paths)
+        scores = score_edition(matrix)
+        create_score_files(scores, paths)
+        create_rarity_table(matrix, scores, paths['rarity'])
+
+
+if __name__ == '__main__':
+    create_rarity_scores(choose_version())
+    print('Task complete!')
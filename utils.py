@@ -1,13 +1,22 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import csv
+import hashlib
 import json
 import os
 from shutil import rmtree
-from typing import Callable, Dict, List, Union
+from typing import (Any, Callable, Dict, Iterator, List, Optional, Tuple,
+                    Union)
+
+from progressbar import ProgressBar
 
 from config import RARITY_TABLE_PATH
 
 CONFIG_DICT = List[Dict[str, Union[int, str, List[int]]]]
 PNG = -1 * len('.png')
+HASH_CHUNK_SIZE = 1024 * 1024
+# Size, sha256 and the sha256 digests of the blocks of a file
+FileHash = Tuple[int, str, List[bytes]]
 
 # Get file paths based on edition
 def generate_paths(version_path: str, edition_name: str) -> Dict[str, str]:
@@ -17,13 +26,49 @@ def generate_paths(version_path: str, edition_name: str) -> Dict[str, str]:
     csv_path = os.path.join(edition_path, 'assets.csv')
     json_path = os.path.join(edition_path, 'assets.json')
     metadata_path = os.path.join(edition_path, 'metadata')
+    graphs_path = os.path.join(edition_path, 'graphs')
+    groups_path = os.path.join(edition_path, 'groups.json')
+    layers_path = os.path.join(edition_path, 'layers.json')
+    traits_path = os.path.join(edition_path, 'traits.npy')
+    ranks_path = os.path.join(edition_path, 'ranks.npy')
+    state_path = os.path.join(edition_path, 'state.npz')
+    encoding_path = os.path.join(edition_path, 'encoding.json')
+    score_path = os.path.join(edition_path, 'score.txt')
+    score_array_path = os.path.join(edition_path, 'score.npy')
+    rarity_path = os.path.join(edition_path, 'rarity.csv')
+    journal_path = os.path.join(edition_path, 'render.log')
+    report_path = os.path.join(edition_path, 'report.json')
+    sheets_path = os.path.join(edition_path, 'contact sheets')
+    manifest_path = os.path.join(edition_path, 'manifest.json')
     
 
     return {'edition': edition_path,
             'images': images_path,
             'csv': csv_path,
             'json': json_path,
-            'metadata': metadata_path}
+            'metadata': metadata_path,
+            'graphs': graphs_path,
+            'groups': groups_path,
+            'layers': layers_path,
+            'traits': traits_path,
+            'ranks': ranks_path,
+            'state': state_path,
+            'encoding': encoding_path,
+            'score': score_path,
+            'score_array': score_array_path,
+            'rarity': rarity_path,
+            'journal': journal_path,
+            'report': report_path,
+            'sheets': sheets_path,
+            'manifest': manifest_path}
+
+
+# Get the paths of an edition's images saved at a smaller width,
+# which have their own folder and render journal
+def get_variant_paths(paths: Dict[str, str], width: int) -> Dict[str, str]:
+    return {**paths,
+            'images': os.path.join(paths['edition'], f'images {width}'),
+            'journal': os.path.join(paths['edition'], f'render {width}.log')}
 
 
 def create_dir(path: str) -> None:
@@ -36,6 +81,66 @@ def erase_dir(path: str) -> None:
     rmtree(path)
 
 
+# Write a file through a temporary file that replaces it once complete,
+# so a crash never leaves a truncated file behind. With sync, the file
+# reaches the disk before it replaces the old one
+@contextmanager
+def atomic_write(path: str, mode: str = 'w', sync: bool = False,
+                 **kwargs: Any) -> Iterator[Any]:
+    temp_path = path + '.tmp'
+    try:
+        with open(temp_path, mode, **kwargs) as file:
+            yield file
+            if sync:
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+# Hash a file a chunk at a time. If a block size is given, the digests of
+# its blocks are returned too, the whole file's one if it fits in a block
+def hash_file(path: str, block_size: Optional[int] = None) -> FileHash:
+    digest = hashlib.sha256()
+    blocks = []
+    size = 0
+    with open(path, 'rb') as file:
+        multiple = (block_size is not None
+                    and os.fstat(file.fileno()).st_size > block_size)
+        buffer = bytearray(block_size or HASH_CHUNK_SIZE)
+        view = memoryview(buffer)
+        while length := file.readinto(buffer):
+            digest.update(view[:length])
+            if multiple:
+                blocks.append(hashlib.sha256(view[:length]).digest())
+            size += length
+    if block_size is not None and not multiple:
+        blocks = [digest.digest()]
+    return size, digest.hexdigest(), blocks
+
+
+# Hash files in parallel, by path. Missing files are left out
+def hash_files(paths: List[str], bar: Optional[ProgressBar] = None,
+               block_size: Optional[int] = None) -> Dict[str, FileHash]:
+    def hash_existing(path: str) -> Optional[FileHash]:
+        try:
+            return hash_file(path, block_size)
+        except FileNotFoundError:
+            return None
+
+    hashes = {}
+    with ThreadPoolExecutor() as executor:
+        for done, (path, result) in enumerate(zip(
+                paths, executor.map(hash_existing, paths)), start=1):
+            if result is not None:
+                hashes[path] = result
+            if bar is not None:
+                bar.update(done)
+    return hashes
+
+
 def erase_edition(version_path: str, edition_name: str) -> None:
     print('Erasing edition...\n')
     erase_dir(generate_paths(version_path, edition_name)['edition'])
@@ -159,12 +264,3 @@ def extract_rarity_from_csv(version_path: str) -> CONFIG_DICT:
                 layer['rarity_weights'].insert(0, none_percent)
             percentage.append(layer)
     return sorted(percentage, key=lambda x: x['id'])
-
-
-def extract_prev_data(version_path: str,
-                      edition_name: str) -> List[List[List[str]]]:
-    paths = generate_paths(version_path, edition_name)
-    json_data = [v for v in load_json_data(paths['json']).values()]
-    with open(paths['csv'], 'r') as file:
-        csv_data = [row[1:] for row in list(csv.reader(file))[1:]]
-    return list(zip(csv_data, json_data))